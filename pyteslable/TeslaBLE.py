@@ -2,24 +2,103 @@
 import os
 from pyteslable import VCSEC_pb2
 # cryptography
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.backends import default_backend
 # encoding
 import binascii
+import struct
+from uuid import UUID
 # ble
 import simplepyble
 # regex
 import re
+import sys
 # files
 from os.path import exists
 # time
 import time
+# reconnect
+import random
+import threading
+from collections import deque, namedtuple, OrderedDict
+import weakref
+# history
+import csv
+import json
+from array import array
+# futures
+from concurrent.futures import Future, wait
+import heapq
+# counters
+import itertools
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Tesla vehicles advertise an iBeacon in Apple's (76) manufacturer data
+TESLA_BEACON_UUID = "74278bda-b644-4520-8f0c-720eaf059935"
+IBEACON_FORMAT = struct.Struct(">BB16sHHb")
+
+Advertisement = namedtuple(
+    "Advertisement", ["uuid", "major", "minor", "tx_power"])
+
+
+def parseAdvertisement(data):
+    # decodes the iBeacon frame a vehicle advertises, or returns None if the
+    # manufacturer data does not hold one
+    if data is None or len(data) < IBEACON_FORMAT.size:
+        return None
+    kind, length, uuid, major, minor, tx_power = IBEACON_FORMAT.unpack_from(
+        data)
+    if kind != 0x02 or length != 0x15:
+        return None
+    return Advertisement(str(UUID(bytes=uuid)), major, minor, tx_power)
+
+
+# one key on a vehicle's whitelist; permissions is a frozenset of
+# WhitelistKeyPermission_E values
+WhitelistKey = namedtuple(
+    "WhitelistKey", ["slot", "public_key", "permissions", "form_factor"])
+
+
+class ScanRecord:
+    # what a scan learned about a car, without creating a Vehicle for it
+    __slots__ = ("address", "name", "rssi",
+                 "advertisement", "adapter", "peripheral")
+
+    def __init__(self, address, name, rssi, advertisement, adapter, peripheral):
+        self.address = address
+        self.name = name
+        self.rssi = rssi
+        self.advertisement = advertisement
+        self.adapter = adapter
+        self.peripheral = peripheral
+
+    def __repr__(self):
+        return "ScanRecord({} ({}), rssi={}, {})".format(
+            self.name, self.address, self.rssi, self.advertisement)
+
+    def isTesla(self):
+        return (self.advertisement is not None
+                and self.advertisement.uuid == TESLA_BEACON_UUID)
 
 
 class BLE:
-    def __init__(self, private_key_file=None):
+    # parsed advertisements kept, least recently seen evicted first
+    ADVERTISEMENT_CACHE = 256
+
+    def __init__(self, private_key_file=None, adapter=None):
+        # adapter is the identifier or address of the adapter to scan with
+        self.__adapter = adapter
+        self.__advertisements = OrderedDict()
+        self.__traffic = {}
+        self.__traffic_limit = (None, 8)
         if private_key_file is None:
             private_key_file = "private_key.pem"
         if not exists(private_key_file):
@@ -49,45 +128,426 @@ class BLE:
     def getPrivateKey(self):
         return self.__private_key
 
-    def scan(self, time=5000):
+    def selectAdapters(self, adapter=None, all_adapters=False):
         adapters = simplepyble.Adapter.get_adapters()
 
         if len(adapters) == 0:
             print("No adapters found")
-        elif len(adapters) == 1:
-            adapter = adapters[0]
-        else:
-            # Query the user to pick an adapter
-            print("Please select an adapter:")
-            for i, adapter in enumerate(adapters):
-                print(f"{i}: {adapter.identifier()} [{adapter.address()}]")
-
-            choice = int(input("Enter choice: "))
-            adapter = adapters[choice]
-
-        adapter.scan_for(time)
-        peripherals = adapter.scan_get_results()
+            return []
+        if all_adapters:
+            return adapters
+        if adapter is None:
+            adapter = self.__adapter
+        if adapter is not None:
+            for candidate in adapters:
+                if adapter in (candidate.identifier(), candidate.address()):
+                    return [candidate]
+            raise Exception("Adapter {} not found".format(adapter))
+        if len(adapters) == 1 or not sys.stdin.isatty():
+            return [adapters[0]]
+
+        # Query the user to pick an adapter
+        print("Please select an adapter:")
+        for i, adapter in enumerate(adapters):
+            print(f"{i}: {adapter.identifier()} [{adapter.address()}]")
+
+        choice = int(input("Enter choice: "))
+        return [adapters[choice]]
+
+    def scan(self, time=5000, adapter=None, all_adapters=False):
         tesla_vehicles = VehicleList()
-        for i, peripheral in enumerate(peripherals):
-            manufacturer_data = peripheral.manufacturer_data()
-            if len(manufacturer_data) > 0 and manufacturer_data.get(76) is not None:
-                tesla_vehicles.add(peripheral, self.__private_key)
+        for record in self.discover(time, adapter, all_adapters):
+            tesla_vehicles.add(record.peripheral, self.__private_key,
+                               self.traffic(record.adapter))
         return tesla_vehicles
 
+    def traffic(self, adapter):
+        # the TrafficShaper shared by every vehicle reached through adapter,
+        # given as an adapter or its address
+        if adapter is None:
+            return None
+        address = adapter if isinstance(adapter, str) else adapter.address()
+        shaper = self.__traffic.get(address)
+        if shaper is None:
+            shaper = TrafficShaper(*self.__traffic_limit)
+            self.__traffic[address] = shaper
+        return shaper
+
+    def rateLimit(self, rate=None, burst=8, adapter=None):
+        # at most rate messages per second through one adapter, or through
+        # each adapter if none is given; None removes the limit
+        if adapter is not None:
+            self.traffic(adapter).limit(rate, burst)
+            return
+        self.__traffic_limit = (rate, burst)
+        for shaper in self.__traffic.values():
+            shaper.limit(rate, burst)
+
+    def stats(self):
+        # traffic counters per adapter address
+        return {address: shaper.stats() for address, shaper in self.__traffic.items()}
+
+    def discover(self, time=5000, adapter=None, all_adapters=False):
+        # scans with the configured adapter, or with every adapter at once if
+        # all_adapters is set, and returns a ScanRecord per car without
+        # connecting. A car seen by several adapters is bound to the
+        # least-loaded one, preferring the strongest RSSI.
+        adapters = self.selectAdapters(adapter, all_adapters)
+        results = [[] for _ in adapters]
+
+        def scan_adapter(i):
+            adapters[i].scan_for(time)
+            results[i] = adapters[i].scan_get_results()
+
+        threads = [threading.Thread(target=scan_adapter, args=(i,))
+                   for i in range(1, len(adapters))]
+        for thread in threads:
+            thread.start()
+        if adapters:
+            scan_adapter(0)
+        for thread in threads:
+            thread.join()
+
+        candidates = {}
+        for i, peripherals in enumerate(results):
+            for peripheral in peripherals:
+                address = peripheral.address()
+                record = ScanRecord(
+                    address, peripheral.identifier(), peripheral.rssi(),
+                    self.__parseAdvertisement(
+                        address, peripheral.manufacturer_data().get(76)),
+                    adapters[i], peripheral)
+                # phones and headphones also send Apple (76) data
+                if record.isTesla():
+                    candidates.setdefault(address, []).append(record)
+
+        load = {a.address(): self.__adapterLoad(a) for a in adapters}
+        records = []
+        for found in candidates.values():
+            record = min(found, key=lambda r: (
+                load[r.adapter.address()], -r.rssi))
+            load[record.adapter.address()] += 1
+            records.append(record)
+        return records
+
+    def __parseAdvertisement(self, address, data):
+        # parsed advertisements are cached per address and only re-parsed
+        # when the payload changes
+        cached = self.__advertisements.get(address)
+        if cached is not None and cached[0] == data:
+            self.__advertisements.move_to_end(address)
+            return cached[1]
+        advertisement = parseAdvertisement(data)
+        self.__advertisements[address] = (data, advertisement)
+        self.__advertisements.move_to_end(address)
+        if len(self.__advertisements) > self.ADVERTISEMENT_CACHE:
+            self.__advertisements.popitem(last=False)
+        return advertisement
+
+    def advertisement(self, address):
+        cached = self.__advertisements.get(address)
+        return None if cached is None else cached[1]
+
+    def __adapterLoad(self, adapter):
+        try:
+            return len(adapter.get_connected_peripherals())
+        except Exception:
+            return 0
+
     def get_vehicle_by_name(self, name):
         return self.scan().getName(name)
 
     def get_vehicle_by_address(self, address):
         return self.scan().getAddress(address)
 
+    def enroll(self, addresses=None, time=5000, adapter=None, all_adapters=False, **kwargs):
+        # scans, then whitelists our key on every car found (or only those in
+        # addresses) in parallel; returns the running Enrollment
+        records = [record for record in self.discover(time, adapter, all_adapters)
+                   if addresses is None or record.address in addresses]
+        traffic = {record.address: self.traffic(record.adapter) for record in records}
+        enrollment = Enrollment(records, self.__private_key, traffic=traffic, **kwargs)
+        enrollment.start()
+        return enrollment
+
+    def presence(self, adapter=None, all_adapters=False, **kwargs):
+        # starts continuous scanning and returns a PresenceEngine fed by it
+        engine = PresenceEngine(**kwargs)
+        for selected in self.selectAdapters(adapter, all_adapters):
+            engine.start(selected)
+        return engine
+
+
+class Enrollment:
+    # Whitelists one key on many cars at once. Each adapter keeps up to
+    # max_connections cars connected with a whitelist request pending, so
+    # staff can tap keycards in any order; a car's slot is handed to the next
+    # one as soon as it is added, fails, or times out waiting for a tap.
+    # Progress is reported through onProgress(vehicle, state) as it happens.
+    STATES = ("queued", "connecting", "waiting", "added", "failed")
+
+    def __init__(self, records, private_key, max_connections=4, poll_interval=None, tap_timeout=300.0,
+                 onProgress=None, traffic=None):
+        self.max_connections = max_connections
+        self.poll_interval = poll_interval
+        self.tap_timeout = tap_timeout
+        self.onProgress = onProgress
+        self.__queues = {}
+        self.__vehicles = {}
+        self.__states = {}
+        self.__errors = {}
+        for record in records:
+            vehicle = Vehicle(record.peripheral, private_key,
+                              traffic=None if traffic is None else traffic.get(record.address))
+            self.__vehicles[record.address] = vehicle
+            self.__states[record.address] = "queued"
+            key = None if record.adapter is None else record.adapter.address()
+            self.__queues.setdefault(key, deque()).append(vehicle)
+        self.__lock = threading.Lock()
+        self.__stopping = threading.Event()
+        self.__threads = []
+
+    def start(self):
+        for queue in self.__queues.values():
+            for _ in range(min(self.max_connections, len(queue))):
+                thread = threading.Thread(target=self.__worker, args=(queue,), daemon=True)
+                thread.start()
+                self.__threads.append(thread)
+
+    def stop(self):
+        self.__stopping.set()
+
+    def wait(self, timeout=None):
+        # returns True once every car has been added or has failed
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self.__threads:
+            thread.join(None if deadline is None else max(0.0, deadline - time.time()))
+        return not any(thread.is_alive() for thread in self.__threads)
+
+    def vehicles(self):
+        return dict(self.__vehicles)
+
+    def states(self):
+        return dict(self.__states)
+
+    def errors(self):
+        return dict(self.__errors)
+
+    def progress(self):
+        counts = dict.fromkeys(self.STATES, 0)
+        for state in self.__states.values():
+            counts[state] += 1
+        return counts
+
+    def __worker(self, queue):
+        while not self.__stopping.is_set():
+            try:
+                vehicle = queue.popleft()
+            except IndexError:
+                return
+            try:
+                self.__enroll(vehicle)
+            except Exception as e:
+                self.__errors[vehicle.address()] = e
+                self.__setState(vehicle, "failed")
+            finally:
+                try:
+                    vehicle.disconnect()
+                except Exception:
+                    pass
+
+    def __enroll(self, vehicle):
+        self.__setState(vehicle, "connecting")
+        vehicle.connect()
+        if not vehicle.isAdded():
+            vehicle.requestWhitelist()
+            self.__setState(vehicle, "waiting")
+            deadline = time.time() + self.tap_timeout
+            while not vehicle.isAdded():
+                if self.__stopping.is_set() or time.time() > deadline:
+                    raise TimeoutError("Keycard was not tapped")
+                vehicle.requestSessionInfo()
+                # the session info reply arrives once the key is added
+                poll_interval = self.poll_interval
+                if poll_interval is None:
+                    poll_interval = vehicle.replyTimeout()
+                vehicle.waitForSession(poll_interval)
+        self.__setState(vehicle, "added")
+
+    def __setState(self, vehicle, state):
+        with self.__lock:
+            self.__states[vehicle.address()] = state
+        if self.onProgress is not None:
+            self.onProgress(vehicle, state)
+        else:
+            print("{}: {}".format(vehicle.address(), state))
+
+
+class PresenceEngine:
+    # Tracks how close advertising Teslas are from a continuous scan. RSSI is
+    # smoothed per car with an EWMA, and all per-car state lives in arrays
+    # preallocated for `capacity` cars, so a packet only costs a few array
+    # writes. Events use separate enter/leave thresholds (hysteresis) and are
+    # delivered as func(event, address, rssi), event being "enter", "near",
+    # "far" or "leave".
+    AWAY = 0
+    PRESENT = 1
+    NEAR = 2
+
+    def __init__(self, capacity=512, alpha=0.25, enter_rssi=-85, leave_rssi=-92,
+                 near_rssi=-60, far_rssi=-66, timeout=10.0):
+        self.alpha = alpha
+        self.enter_rssi = enter_rssi
+        self.leave_rssi = leave_rssi
+        self.near_rssi = near_rssi
+        self.far_rssi = far_rssi
+        self.timeout = timeout
+        self.__capacity = capacity
+        self.__rssi = array("d", [0.0]) * capacity
+        self.__seen = array("d", [0.0]) * capacity
+        self.__state = array("B", [0]) * capacity
+        self.__addresses = [None] * capacity
+        self.__slots = {}
+        self.__free = list(range(capacity - 1, -1, -1))
+        # address -> whether it advertises the Tesla beacon
+        self.__verdicts = {}
+        self.__listeners = []
+        self.__adapters = []
+        self.__lock = threading.Lock()
+        self.__running = False
+        self.dropped = 0
+
+    def onEvent(self, func):
+        self.__listeners = self.__listeners + [func]
+
+    def start(self, adapter):
+        adapter.set_callback_on_scan_found(self.__onAdvertisement)
+        adapter.set_callback_on_scan_updated(self.__onAdvertisement)
+        adapter.scan_start()
+        self.__adapters.append(adapter)
+        if not self.__running:
+            self.__running = True
+            threading.Thread(target=self.__expireLoop, daemon=True).start()
+
+    def stop(self):
+        self.__running = False
+        for adapter in self.__adapters:
+            adapter.scan_stop()
+        self.__adapters = []
+
+    def __onAdvertisement(self, peripheral):
+        address = peripheral.address()
+        if address not in self.__slots:
+            # phones and headphones also send Apple (76) data, so only the
+            # Tesla beacon counts; the verdict is parsed once per address
+            verdict = self.__verdicts.get(address)
+            if verdict is None:
+                advertisement = parseAdvertisement(peripheral.manufacturer_data().get(76))
+                verdict = advertisement is not None and advertisement.uuid == TESLA_BEACON_UUID
+                if len(self.__verdicts) > 4 * self.__capacity:
+                    self.__verdicts.clear()
+                self.__verdicts[address] = verdict
+            if not verdict:
+                return
+        self.observe(address, peripheral.rssi())
+
+    def observe(self, address, rssi, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self.__lock:
+            slot = self.__slots.get(address)
+            if slot is None:
+                if not self.__free:
+                    self.dropped += 1
+                    return
+                slot = self.__free.pop()
+                self.__slots[address] = slot
+                self.__addresses[slot] = address
+                self.__rssi[slot] = rssi
+            else:
+                self.__rssi[slot] += self.alpha * (rssi - self.__rssi[slot])
+            self.__seen[slot] = timestamp
+            smoothed = self.__rssi[slot]
+            state = self.__state[slot]
+            # only transitions allocate
+            events = ()
+            if state == self.AWAY:
+                if smoothed >= self.enter_rssi:
+                    state = self.PRESENT
+                    events += ("enter",)
+            elif smoothed < self.leave_rssi:
+                if state == self.NEAR:
+                    events += ("far",)
+                state = self.AWAY
+                events += ("leave",)
+            if state == self.PRESENT and smoothed >= self.near_rssi:
+                state = self.NEAR
+                events += ("near",)
+            elif state == self.NEAR and smoothed < self.far_rssi:
+                state = self.PRESENT
+                events += ("far",)
+            self.__state[slot] = state
+            if state == self.AWAY and events:
+                self.__release(slot)
+        for event in events:
+            self.__emit(event, address, smoothed)
+
+    def expire(self, now=None):
+        # cars that stopped advertising for `timeout` seconds have left
+        if now is None:
+            now = time.time()
+        expired = []
+        with self.__lock:
+            for address, slot in list(self.__slots.items()):
+                if now - self.__seen[slot] >= self.timeout:
+                    if self.__state[slot] == self.NEAR:
+                        expired.append(("far", address, self.__rssi[slot]))
+                    if self.__state[slot] != self.AWAY:
+                        expired.append(("leave", address, self.__rssi[slot]))
+                    self.__release(slot)
+        for event in expired:
+            self.__emit(*event)
+
+    def __release(self, slot):
+        del self.__slots[self.__addresses[slot]]
+        self.__addresses[slot] = None
+        self.__state[slot] = self.AWAY
+        self.__free.append(slot)
+
+    def __emit(self, event, address, rssi):
+        for func in self.__listeners:
+            func(event, address, rssi)
+
+    def __expireLoop(self):
+        while self.__running:
+            time.sleep(min(1.0, self.timeout / 2))
+            self.expire()
+
+    def rssi(self, address):
+        slot = self.__slots.get(address)
+        return None if slot is None else self.__rssi[slot]
+
+    def isPresent(self, address):
+        slot = self.__slots.get(address)
+        return slot is not None and self.__state[slot] != self.AWAY
+
+    def isNear(self, address):
+        slot = self.__slots.get(address)
+        return slot is not None and self.__state[slot] == self.NEAR
+
+    def present(self):
+        with self.__lock:
+            return [address for address, slot in self.__slots.items()
+                    if self.__state[slot] != self.AWAY]
+
 
 class VehicleList:
     def __init__(self):
         self.__vehicles = []
 
-    def add(self, peripheral, private_key):
+    def add(self, peripheral, private_key, traffic=None):
         self.__vehicles.append(
-            Vehicle(peripheral, private_key))
+            Vehicle(peripheral, private_key, traffic=traffic))
 
     def getName(self, name):
         if not re.match("^S[a-f\d]{16}[A-F]$", name):
@@ -122,19 +582,867 @@ class VehicleList:
         return result + "]"
 
 
+class VehicleState:
+    # Immutable snapshot of a VehicleStatus message, packed into one int. Each
+    # field takes two bits holding the raw enum value, so AJAR and UNKNOWN
+    # closures and the sleep status are kept as reported.
+    __slots__ = ("_bits",)
+
+    FIELDS = (
+        "frontDriverDoor",
+        "frontPassengerDoor",
+        "rearDriverDoor",
+        "rearPassengerDoor",
+        "rearTrunk",
+        "frontTrunk",
+        "chargePort",
+        "vehicleLockState",
+        "vehicleSleepStatus",
+    )
+    CLOSURES = FIELDS[:7]
+    BITS = 2
+    MASK = (1 << BITS) - 1
+
+    def __init__(self, bits=0):
+        object.__setattr__(self, "_bits", bits)
+
+    @classmethod
+    def fromStatus(cls, status):
+        closure_status = status.closureStatuses
+        bits = 0
+        for i, name in enumerate(cls.CLOSURES):
+            bits |= (getattr(closure_status, name) & cls.MASK) << (i * cls.BITS)
+        bits |= (status.vehicleLockState & cls.MASK) << (7 * cls.BITS)
+        bits |= (status.vehicleSleepStatus & cls.MASK) << (8 * cls.BITS)
+        return cls(bits)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("VehicleState is immutable")
+
+    def __eq__(self, other):
+        return isinstance(other, VehicleState) and self._bits == other._bits
+
+    def __hash__(self):
+        return hash(self._bits)
+
+    def __int__(self):
+        return self._bits
+
+    def __repr__(self):
+        return "VehicleState({})".format(", ".join(
+            "{}={}".format(name, self.get(name)) for name in self.FIELDS))
+
+    def get(self, name):
+        return (self._bits >> (self.FIELDS.index(name) * self.BITS)) & self.MASK
+
+    def diff(self, previous):
+        # names of the fields that differ from the previous state
+        if previous is None:
+            return self.FIELDS
+        changed = self._bits ^ previous._bits
+        if not changed:
+            return ()
+        return tuple(name for i, name in enumerate(self.FIELDS)
+                     if (changed >> (i * self.BITS)) & self.MASK)
+
+    def isOpen(self, closure):
+        return self.get(closure) == VCSEC_pb2.CLOSURESTATE_OPEN
+
+    def isLocked(self):
+        return self.vehicleLockState == VCSEC_pb2.VEHICLELOCKSTATE_LOCKED
+
+    def isAsleep(self):
+        return self.vehicleSleepStatus == VCSEC_pb2.VEHICLE_SLEEP_STATUS_ASLEEP
+
+    def asDict(self):
+        return {
+            "locked": self.isLocked(),
+            "charge_port_open": self.isOpen("chargePort"),
+            "front_driver_door_open": self.isOpen("frontDriverDoor"),
+            "rear_driver_door_open": self.isOpen("rearDriverDoor"),
+            "front_passenger_door_open": self.isOpen("frontPassengerDoor"),
+            "rear_passenger_door_open": self.isOpen("rearPassengerDoor"),
+            "rear_trunk_open": self.isOpen("rearTrunk"),
+            "front_trunk_open": self.isOpen("frontTrunk")
+        }
+
+
+def _stateField(index):
+    shift = index * VehicleState.BITS
+    return property(lambda self: (self._bits >> shift) & VehicleState.MASK)
+
+
+for _index, _name in enumerate(VehicleState.FIELDS):
+    setattr(VehicleState, _name, _stateField(_index))
+del _index, _name
+
+
+class StatusHistory:
+    # Fixed-size ring buffer of (timestamp, VehicleState bits) pairs. Both
+    # columns are preallocated arrays, so memory stays constant however long
+    # the recorder runs; the oldest entries are overwritten when it is full.
+    def __init__(self, capacity=4096):
+        self.__capacity = capacity
+        self.__times = array("d", [0.0]) * capacity
+        self.__bits = array("L", [0]) * capacity
+        self.__start = 0
+        self.__count = 0
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return self.__count
+
+    def capacity(self):
+        return self.__capacity
+
+    def record(self, state, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self.__lock:
+            if self.__count < self.__capacity:
+                index = (self.__start + self.__count) % self.__capacity
+                self.__count += 1
+            else:
+                index = self.__start
+                self.__start = (self.__start + 1) % self.__capacity
+            self.__times[index] = timestamp
+            self.__bits[index] = int(state)
+
+    def clear(self):
+        with self.__lock:
+            self.__start = 0
+            self.__count = 0
+
+    def __bisect(self, timestamp):
+        # index of the first entry recorded at or after timestamp
+        low, high = 0, self.__count
+        while low < high:
+            middle = (low + high) // 2
+            if self.__times[(self.__start + middle) % self.__capacity] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __range(self, start, end):
+        first = 0 if start is None else self.__bisect(start)
+        last = self.__count if end is None else self.__bisect(end)
+        return first, max(first, last)
+
+    def __slice(self, column, first, last):
+        # copies entries [first, last) out of the ring in recorded order
+        begin = (self.__start + first) % self.__capacity
+        end = begin + (last - first)
+        if end <= self.__capacity:
+            return column[begin:end]
+        return column[begin:] + column[:end - self.__capacity]
+
+    def range(self, start=None, end=None):
+        # (timestamp, VehicleState) pairs recorded in [start, end)
+        times, bits = self.raw(start, end)
+        return [(t, VehicleState(b)) for t, b in zip(times, bits)]
+
+    def raw(self, start=None, end=None):
+        with self.__lock:
+            first, last = self.__range(start, end)
+            return (self.__slice(self.__times, first, last),
+                    self.__slice(self.__bits, first, last))
+
+    def latest(self):
+        with self.__lock:
+            if self.__count == 0:
+                return None
+            index = (self.__start + self.__count - 1) % self.__capacity
+            return self.__times[index], VehicleState(self.__bits[index])
+
+    def columns(self, start=None, end=None):
+        # one array per column, ready for csv or a columnar table such as
+        # pyarrow.table(history.columns())
+        times, bits = self.raw(start, end)
+        result = {"timestamp": times}
+        for i, name in enumerate(VehicleState.FIELDS):
+            shift = i * VehicleState.BITS
+            result[name] = array(
+                "B", ((b >> shift) & VehicleState.MASK for b in bits))
+        return result
+
+    def toCSV(self, file, start=None, end=None):
+        columns = self.columns(start, end)
+        names = list(columns)
+        close = isinstance(file, str)
+        if close:
+            file = open(file, "w", newline="")
+        try:
+            writer = csv.writer(file)
+            writer.writerow(names)
+            writer.writerows(zip(*(columns[name] for name in names)))
+        finally:
+            if close:
+                file.close()
+
+
+class StatusMonitor:
+    # Shares one status stream between any number of subscribers. Unsolicited
+    # vehicleStatus notifications are used when the car sends them; a status
+    # request is only sent when none has arrived within the current interval.
+    # The interval shortens after a command and lengthens while the car sleeps.
+    def __init__(self, vehicle, interval=10.0, fast_interval=1.0, sleep_interval=60.0, boost=10.0):
+        self.__vehicle = vehicle
+        self.interval = interval
+        self.fast_interval = fast_interval
+        self.sleep_interval = sleep_interval
+        self.boost = boost
+        self.__subscribers = []
+        self.__lock = threading.Lock()
+        self.__wake = threading.Event()
+        self.__thread = None
+        self.__running = False
+        self.__last_poll = 0.0
+        self.__polls = 0
+
+    def subscribe(self, func):
+        # func is called as func(vehicle, state, changed)
+        with self.__lock:
+            self.__subscribers = self.__subscribers + [func]
+            if not self.__running:
+                self.__running = True
+                self.__vehicle.addStateListener(self.__dispatch)
+                self.__thread = threading.Thread(
+                    target=self.__run, daemon=True)
+                self.__thread.start()
+        return func
+
+    def unsubscribe(self, func):
+        with self.__lock:
+            self.__subscribers = [f for f in self.__subscribers if f is not func]
+            if not self.__subscribers:
+                self.stop()
+
+    def stop(self):
+        self.__running = False
+        self.__vehicle.removeStateListener(self.__dispatch)
+        self.__wake.set()
+
+    def poke(self):
+        # re-evaluates the poll interval straight away, e.g. after a command
+        self.__wake.set()
+
+    def polls(self):
+        return self.__polls
+
+    def currentInterval(self):
+        if time.time() - self.__vehicle.lastCommandTime() < self.boost:
+            return self.fast_interval
+        state = self.__vehicle.state()
+        if state is not None and state.isAsleep():
+            return self.sleep_interval
+        return self.interval
+
+    def __dispatch(self, vehicle, state, changed):
+        for func in self.__subscribers:
+            func(vehicle, state, changed)
+
+    def __run(self):
+        while self.__running:
+            interval = self.currentInterval()
+            # any status the car pushed counts as a poll
+            last = max(self.__vehicle.lastStatusTime(), self.__last_poll)
+            wait = last + interval - time.time()
+            if wait <= 0:
+                self.__last_poll = time.time()
+                wait = interval
+                if self.__vehicle.isConnected() and self.__vehicle.isAdded():
+                    try:
+                        # a poll still queued when the next is due is stale
+                        self.__vehicle.vehicle_status(
+                            priority=PRIORITY_BACKGROUND, deadline=time.time() + interval)
+                        self.__polls += 1
+                    except Exception as e:
+                        if self.__vehicle.is_debug():
+                            print("Status poll failed: {}".format(e))
+            self.__wake.wait(wait)
+            self.__wake.clear()
+
+
+class WakeScheduler:
+    # Groups commands so a sleeping car is woken once for all of them. Waking
+    # VCSEC adds a large, variable delay to the first command, so a command
+    # queued while the car sleeps waits up to max_delay for others to join it
+    # before the group is sent as one batch; while awake, commands go out at
+    # once. keepAwake() keeps the link busy with a status request every
+    # keepalive_interval so the car does not fall asleep between commands of
+    # a known batch. A longer max_delay saves wake-ups at the cost of latency;
+    # a shorter keepalive_interval costs the car energy.
+    def __init__(self, vehicle, max_delay=2.0, keepalive_interval=5.0, window=4, timeout=None):
+        self.__vehicle = vehicle
+        self.max_delay = max_delay
+        self.keepalive_interval = keepalive_interval
+        self.window = window
+        self.timeout = timeout
+        self.__queue = []
+        self.__first_queued = None
+        self.__urgent = False
+        self.__awake_until = 0.0
+        self.__lock = threading.Lock()
+        self.__wake = threading.Event()
+        self.__thread = None
+        self.__running = False
+        self.__metrics = {
+            "wake_windows": 0,
+            "commands_grouped": 0,
+            "keepalives": 0,
+        }
+        vehicle.addStateListener(self.__stateChanged)
+
+    def submit(self, name, *args, urgent=False):
+        # queues one CommandBatch command by name, e.g. submit("unlock"), and
+        # returns its Future; urgent commands are sent without waiting
+        return self.submitBatch([(name, args)], urgent)[0]
+
+    def submitBatch(self, commands, urgent=False):
+        # queues a CommandBatch (or a list of (name, args)) and returns a
+        # Future per command
+        if isinstance(commands, CommandBatch):
+            commands = commands.commands()
+        futures = []
+        with self.__lock:
+            for name, args in commands:
+                future = Future()
+                self.__queue.append((name, args, future))
+                futures.append(future)
+            if self.__first_queued is None:
+                self.__first_queued = time.time()
+            self.__urgent = self.__urgent or urgent
+            self.__start()
+        self.__wake.set()
+        return futures
+
+    def keepAwake(self, seconds):
+        # keeps the car awake for at least the given time
+        with self.__lock:
+            self.__awake_until = max(self.__awake_until, time.time() + seconds)
+            self.__start()
+        self.__wake.set()
+
+    def isAsleep(self):
+        state = self.__vehicle.state()
+        return state is not None and state.isAsleep()
+
+    def pending(self):
+        return len(self.__queue)
+
+    def metrics(self):
+        return dict(self.__metrics)
+
+    def stop(self):
+        self.__running = False
+        self.__vehicle.removeStateListener(self.__stateChanged)
+        self.__wake.set()
+
+    def __start(self):
+        if not self.__running:
+            self.__running = True
+            self.__thread = threading.Thread(target=self.__run, daemon=True)
+            self.__thread.start()
+
+    def __stateChanged(self, vehicle, state, changed):
+        # a car that woke up on its own can take the queue straight away
+        if "vehicleSleepStatus" in changed and not state.isAsleep():
+            self.__wake.set()
+
+    def __run(self):
+        while self.__running:
+            now = time.time()
+            wait = None
+            with self.__lock:
+                due = self.__queue and (self.__urgent or not self.isAsleep()
+                                        or now - self.__first_queued >= self.max_delay)
+                if due:
+                    queue, self.__queue = self.__queue, []
+                    self.__first_queued = None
+                    self.__urgent = False
+                elif self.__queue:
+                    wait = self.__first_queued + self.max_delay - now
+            if due:
+                self.__flush(queue)
+                continue
+            if now < self.__awake_until:
+                last = max(self.__vehicle.lastStatusTime(), self.__vehicle.lastCommandTime())
+                keepalive = last + self.keepalive_interval - now
+                if keepalive <= 0:
+                    self.__keepalive()
+                    keepalive = self.keepalive_interval
+                keepalive = min(keepalive, self.__awake_until - now)
+                wait = keepalive if wait is None else min(wait, keepalive)
+            self.__wake.wait(wait)
+            self.__wake.clear()
+
+    def __flush(self, queue):
+        self.__metrics["wake_windows"] += 1
+        self.__metrics["commands_grouped"] += len(queue)
+        try:
+            results = self.__vehicle.runBatch(
+                [(name, args) for name, args, _ in queue], self.window, self.timeout)
+        except Exception as e:
+            for _, _, future in queue:
+                future.set_exception(e)
+            return
+        for (_, _, future), result in zip(queue, results):
+            result.add_done_callback(lambda done, future=future: self.__settle(future, done))
+
+    @staticmethod
+    def __settle(future, done):
+        if done.exception() is not None:
+            future.set_exception(done.exception())
+        else:
+            future.set_result(done.result())
+
+    def __keepalive(self):
+        if not (self.__vehicle.isConnected() and self.__vehicle.isAdded()):
+            return
+        try:
+            self.__vehicle.vehicle_status(
+                priority=PRIORITY_BACKGROUND, deadline=time.time() + self.keepalive_interval)
+            self.__metrics["keepalives"] += 1
+        except Exception as e:
+            if self.__vehicle.is_debug():
+                print("Keep-awake request failed: {}".format(e))
+
+
+def _readVarint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise IndexError("varint too long")
+
+
+def decodeVehicleStatus(data):
+    # Decodes a FromVCSECMessage that holds only a vehicleStatus straight into
+    # VehicleState bits. Returns None for any other message, or anything
+    # unexpected, so the caller can fall back to the protobuf parser.
+    try:
+        tag, pos = _readVarint(data, 0)
+        if tag != 0x0A:  # field 1 (vehicleStatus), length delimited
+            return None
+        length, pos = _readVarint(data, pos)
+        end = pos + length
+        if end != len(data):
+            return None
+        bits = 0
+        while pos < end:
+            tag, pos = _readVarint(data, pos)
+            if tag == 0x0A:  # field 1 (closureStatuses), length delimited
+                length, pos = _readVarint(data, pos)
+                closures_end = pos + length
+                if closures_end > end:
+                    return None
+                while pos < closures_end:
+                    tag, pos = _readVarint(data, pos)
+                    field = tag >> 3
+                    if tag & 7 != 0 or not 1 <= field <= 7:
+                        return None
+                    value, pos = _readVarint(data, pos)
+                    if value > VehicleState.MASK:
+                        return None
+                    shift = (field - 1) * VehicleState.BITS
+                    bits = (bits & ~(VehicleState.MASK << shift)) | (value << shift)
+                if pos != closures_end:
+                    return None
+            elif tag == 0x10 or tag == 0x18:  # vehicleLockState, vehicleSleepStatus
+                value, pos = _readVarint(data, pos)
+                if value > VehicleState.MASK:
+                    return None
+                shift = (7 if tag == 0x10 else 8) * VehicleState.BITS
+                bits = (bits & ~(VehicleState.MASK << shift)) | (value << shift)
+            else:
+                return None
+        if pos != end:
+            return None
+        return bits
+    except IndexError:
+        return None
+
+
+# priority classes for writes to a vehicle, most urgent first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_AUTOMATION = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = ("interactive", "automation", "background")
+
+
+class SendQueue:
+    # Hands the link to one writer at a time, highest priority class first
+    # and in arrival order within a class, so a user's unlock never waits
+    # behind queued status polls, only behind the frame already on the wire.
+    # A writer still waiting at its deadline is dropped with a TimeoutError
+    # instead of sending a stale request. The owner may re-enter.
+    def __init__(self):
+        self.__cond = threading.Condition(threading.Lock())
+        self.__waiting = []
+        self.__sequence = itertools.count()
+        self.__owner = None
+        self.__depth = 0
+        self.__metrics = {}
+        for name in PRIORITY_NAMES:
+            self.__metrics[name + "_sent"] = 0
+            self.__metrics[name + "_dropped"] = 0
+            self.__metrics[name + "_wait_max"] = 0.0
+
+    @contextmanager
+    def slot(self, priority=PRIORITY_AUTOMATION, deadline=None):
+        self.acquire(priority, deadline)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self, priority=PRIORITY_AUTOMATION, deadline=None):
+        me = threading.get_ident()
+        name = PRIORITY_NAMES[priority]
+        with self.__cond:
+            if self.__owner == me:
+                self.__depth += 1
+                return
+            queued = time.time()
+            entry = (priority, next(self.__sequence), me)
+            heapq.heappush(self.__waiting, entry)
+            while self.__owner is not None or self.__waiting[0] is not entry:
+                timeout = None if deadline is None else deadline - time.time()
+                if timeout is not None and timeout <= 0:
+                    self.__waiting.remove(entry)
+                    heapq.heapify(self.__waiting)
+                    self.__metrics[name + "_dropped"] += 1
+                    self.__cond.notify_all()
+                    raise TimeoutError("Deadline passed before sending")
+                self.__cond.wait(timeout)
+            heapq.heappop(self.__waiting)
+            self.__owner = me
+            self.__depth = 1
+            self.__metrics[name + "_sent"] += 1
+            waited = time.time() - queued
+            if waited > self.__metrics[name + "_wait_max"]:
+                self.__metrics[name + "_wait_max"] = waited
+
+    def release(self):
+        with self.__cond:
+            self.__depth -= 1
+            if self.__depth == 0:
+                self.__owner = None
+                self.__cond.notify_all()
+
+    def waiting(self):
+        return len(self.__waiting)
+
+    def metrics(self):
+        return dict(self.__metrics)
+
+
+class RttEstimator:
+    # Round-trip time to one car, smoothed as TCP does (RFC 6298): srtt and
+    # rttvar follow each sample, and the reply timeout is srtt + 4 * rttvar,
+    # kept between minimum and maximum. A missed reply doubles the timeout
+    # until the next sample. Samples only come from replies that can be
+    # matched to one send, never from retransmitted messages.
+    ALPHA = 0.125
+    BETA = 0.25
+
+    def __init__(self, initial=3.0, minimum=1.0, maximum=10.0, granularity=0.01):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.granularity = granularity
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial
+        self.last = None
+        self.samples = 0
+        self.backoffs = 0
+        self.__lock = threading.Lock()
+
+    def sample(self, rtt):
+        with self.__lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar += self.BETA * (abs(self.srtt - rtt) - self.rttvar)
+                self.srtt += self.ALPHA * (rtt - self.srtt)
+            self.last = rtt
+            self.samples += 1
+            self.rto = min(self.maximum, max(
+                self.minimum, self.srtt + max(self.granularity, 4 * self.rttvar)))
+
+    def backoff(self):
+        with self.__lock:
+            self.backoffs += 1
+            self.rto = min(self.maximum, self.rto * 2)
+
+    def timeout(self):
+        return self.rto
+
+    def metrics(self):
+        return {
+            "rtt_srtt": self.srtt,
+            "rtt_rttvar": self.rttvar,
+            "rtt_rto": self.rto,
+            "rtt_last": self.last,
+            "rtt_samples": self.samples,
+            "rtt_backoffs": self.backoffs,
+        }
+
+
+class TrafficShaper:
+    # Counts what goes over a link in both directions and, when rate is set,
+    # limits messages sent to rate per second with bursts of up to burst. A
+    # vehicle's shaper has its adapter's as parent, so a message must fit
+    # both buckets and is counted in both.
+    COUNTERS = ("tx_bytes", "tx_frames", "tx_messages",
+                "rx_bytes", "rx_frames", "rx_messages",
+                "throttled", "throttle_time")
+
+    def __init__(self, rate=None, burst=8, parent=None):
+        self.parent = parent
+        self.__lock = threading.Lock()
+        self.__stats = dict.fromkeys(self.COUNTERS, 0)
+        self.__stats["throttle_time"] = 0.0
+        self.limit(rate, burst)
+
+    def limit(self, rate=None, burst=8):
+        with self.__lock:
+            self.rate = rate
+            self.burst = burst
+            self.__tokens = float(burst)
+            self.__stamp = time.monotonic()
+
+    def take(self):
+        # reserves one message; tokens may go negative, and the caller sleeps
+        # until its reservation is covered
+        if self.rate is not None:
+            with self.__lock:
+                now = time.monotonic()
+                self.__tokens = min(self.burst, self.__tokens + (now - self.__stamp) * self.rate)
+                self.__stamp = now
+                self.__tokens -= 1
+                delay = -self.__tokens / self.rate if self.__tokens < 0 else 0.0
+                if delay:
+                    self.__stats["throttled"] += 1
+                    self.__stats["throttle_time"] += delay
+            if delay:
+                time.sleep(delay)
+        if self.parent is not None:
+            self.parent.take()
+
+    def sent(self, nbytes, frames):
+        with self.__lock:
+            self.__stats["tx_bytes"] += nbytes
+            self.__stats["tx_frames"] += frames
+            self.__stats["tx_messages"] += 1
+        if self.parent is not None:
+            self.parent.sent(nbytes, frames)
+
+    def received(self, nbytes):
+        with self.__lock:
+            self.__stats["rx_bytes"] += nbytes
+            self.__stats["rx_frames"] += 1
+        if self.parent is not None:
+            self.parent.received(nbytes)
+
+    def handled(self):
+        with self.__lock:
+            self.__stats["rx_messages"] += 1
+        if self.parent is not None:
+            self.parent.handled()
+
+    def stats(self):
+        with self.__lock:
+            return dict(self.__stats)
+
+
+class CommandBatch:
+    # Collects commands to send as a pipeline, e.g.
+    # vehicle.batch().vehicle_status().unlock().open_charge_port().execute()
+    def __init__(self, vehicle):
+        self.__vehicle = vehicle
+        self.__commands = []
+
+    def __len__(self):
+        return len(self.__commands)
+
+    def commands(self):
+        return list(self.__commands)
+
+    def __add(self, name, *args):
+        self.__commands.append((name, args))
+        return self
+
+    def unlock(self):
+        return self.__add("unlock")
+
+    def lock(self):
+        return self.__add("lock")
+
+    def open_trunk(self):
+        return self.__add("open_trunk")
+
+    def open_frunk(self):
+        return self.__add("open_frunk")
+
+    def open_charge_port(self):
+        return self.__add("open_charge_port")
+
+    def close_charge_port(self):
+        return self.__add("close_charge_port")
+
+    def move_closures(self, moves):
+        return self.__add("move_closures", moves)
+
+    def vehicle_status(self):
+        return self.__add("vehicle_status")
+
+    def submit(self, window=4, timeout=None):
+        # sends the batch and returns a Future per command; blocks while
+        # earlier windows are answered, but not for the replies to the last
+        return self.__vehicle.runBatch(self.__commands, window, timeout)
+
+    def execute(self, window=4, timeout=None):
+        # sends the batch and returns every command's result in order; a
+        # command that failed or timed out has its exception in its place
+        futures = self.submit(window, timeout)
+        wait(futures, self.__vehicle.replyTimeout() if timeout is None else timeout)
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(timeout=0))
+            except Exception as e:
+                results.append(e)
+        return results
+
+
+def _frameCounter(frame):
+    # the counter a length-prefixed signed frame was signed with
+    msg = VCSEC_pb2.ToVCSECMessage()
+    msg.ParseFromString(frame[2:])
+    if not msg.HasField("signedMessage"):
+        return None
+    return msg.signedMessage.counter
+
+
+class _AwaitedReply:
+    # a signed command waiting for its commandStatus; build re-signs it if
+    # the car rejects its counter
+    __slots__ = ("future", "deadline", "build", "idempotent", "counter", "attempts")
+
+    def __init__(self, future, deadline, build, idempotent):
+        self.future = future
+        self.deadline = deadline
+        self.build = build
+        self.idempotent = idempotent
+        self.counter = None
+        self.attempts = 1
+
+    def frame(self):
+        frame = bytes(self.build())
+        self.counter = _frameCounter(frame)
+        return frame
+
+
 class Vehicle:
-    def __init__(self, peripheral, private_key):
+    def __init__(self, peripheral, private_key, counter_block=32, traffic=None):
+        # traffic is the TrafficShaper of the adapter the car is reached by
         if not exists(".tesladata"):
             os.mkdir(".tesladata")
         file_name = ".tesladata/" + peripheral.address() + ".txt"
         self.file_name = file_name.replace(":", "")
         self.__peripheral = peripheral
-        arr = self.getLineFromFile()
+        self.__file_lock = threading.RLock()
+        self.__counter_block = counter_block
+        with self.__file_lock, self.__lockFile():
+            arr = self.getLineFromFile()
+            self.__file_stamp = self.__fileStamp()
         self.__private_key = private_key
         self.__vehicle_key_str = arr[2]
         self.__counter = int(arr[1])
         self.__service = TeslaMsgService(self)
         self.__debug = False
+        self.__onReconnect = None
+        self.__onStatusChange = None
+        self.__onStateChange = None
+        self.__state = None
+        self.__status = None
+        self.__history = None
+        self.__state_listeners = []
+        self.__monitor = None
+        self.__scheduler = None
+        self.__last_status_time = 0.0
+        self.__last_command_time = 0.0
+        # replies are matched to requests in order, so they are never
+        # dropped; status updates supersede each other and are shed instead
+        self.__inbox = deque()
+        self.__status_inbox = deque(maxlen=64)
+        self.__awaiting = deque()
+        # futures waiting for an information reply, by the same key as
+        # __inflight; both are only touched with __inflight_lock held, and
+        # futures are resolved after releasing it, since their callbacks
+        # may ask again
+        self.__waiters = {}
+        self.__inflight = {}
+        self.__inflight_lock = threading.Lock()
+        self.__vehicle_info = None
+        self.__vehicle_info_time = 0.0
+        self.__capabilities = None
+        self.__capabilities_time = 0.0
+        self.__info_file = self.file_name[:-len(".txt")] + ".json"
+        # filled from disk once connect reads a matching version
+        self.__info_cache = {}
+        self.__whitelist_info = None
+        self.__whitelist_info_time = 0.0
+        self.__request_metrics = {
+            "information_requests": 0,
+            "coalesced_requests": 0,
+            "fresh_hits": 0,
+        }
+        self.__send_queue = SendQueue()
+        self.__traffic = TrafficShaper(parent=traffic)
+        self.__rtt = RttEstimator()
+        # send times of requests awaiting a reply, for RTT samples
+        self.__sent_at = weakref.WeakKeyDictionary()
+        self.__status_sent = None
+        self.__session_ready = threading.Event()
+        self.__chunk_size = None
+        self.__inbox_ready = threading.Event()
+        self.__inbox_thread = None
+        self.__notify_metrics = {
+            "notify_received": 0,
+            "notify_dropped": 0,
+            "notify_dropped_status": 0,
+            "notify_errors": 0,
+            "notify_latency_avg": 0.0,
+            "notify_latency_max": 0.0,
+        }
+        self.__closing = False
+        self.__auto_reconnect = False
+        self.__reconnecting = False
+        self.__auth_requests = {}
+        self.__auth_answered = {}
+        self.__auth_interval = 0.5
+        self.__auth_ready = threading.Event()
+        self.__auth_thread = None
+        self.__auth_metrics = {
+            "auth_requests": 0,
+            "auth_responses": 0,
+            "auth_suppressed": 0,
+            "auth_latency_avg": 0.0,
+            "auth_latency_max": 0.0,
+        }
+        self.__reconnect_lock = threading.Lock()
+        self.__pending = deque(maxlen=16)
+        self.__max_replay_age = 10.0
 
     def __str__(self):
         return f"{self.name()} ({self.address()})"
@@ -145,32 +1453,91 @@ class Vehicle:
     def onStatusChange(self, func):
         self.__onStatusChange = func
 
+    def onStateChange(self, func):
+        # called as func(vehicle, state, changed) with the names of the
+        # VehicleState fields that changed
+        self.__onStateChange = func
+
     def setStatus(self, data):
-        closure_status = data.closureStatuses
-        lock_state = data.vehicleLockState
-        print(lock_state)
-        self.__locked = lock_state == 1
-        self.__charge_port_open = closure_status.chargePort == 1
-        self.__front_driver_door_open = closure_status.frontDriverDoor == 1
-        self.__rear_driver_door_open = closure_status.rearDriverDoor == 1
-        self.__front_passenger_door_open = closure_status.frontPassengerDoor == 1
-        self.__rear_passenger_door_open = closure_status.rearPassengerDoor == 1
-        self.__rear_trunk_open = closure_status.rearTrunk == 1
-        self.__front_trunk_open = closure_status.frontTrunk == 1
+        self.setState(VehicleState.fromStatus(data))
+
+    def setState(self, state):
+        self.__last_status_time = time.time()
+        waiters = self.__takeWaiters("status")
+        # only a status we asked for is a round trip sample
+        if waiters and self.__status_sent is not None:
+            self.__rtt.sample(time.perf_counter() - self.__status_sent)
+            self.__status_sent = None
+        for future in waiters:
+            future.set_result(state)
+        previous = self.__state
+        changed = state.diff(previous)
+        if not changed:
+            return
+        self.__state = state
+        self.__status = state.asDict()
+        if self.__history is not None:
+            self.__history.record(state)
+        for listener in self.__state_listeners:
+            listener(self, state, changed)
+        if self.__onStateChange is not None:
+            self.__onStateChange(self, state, changed)
         if self.__onStatusChange is not None:
             self.__onStatusChange(self)
 
+    def addStateListener(self, func):
+        self.__state_listeners = self.__state_listeners + [func]
+
+    def removeStateListener(self, func):
+        self.__state_listeners = [
+            f for f in self.__state_listeners if f != func]
+
+    def lastStatusTime(self):
+        return self.__last_status_time
+
+    def lastCommandTime(self):
+        return self.__last_command_time
+
+    def monitor(self, **kwargs):
+        # the shared StatusMonitor for this vehicle; keyword arguments update
+        # its intervals
+        if self.__monitor is None:
+            self.__monitor = StatusMonitor(self)
+        for name, value in kwargs.items():
+            setattr(self.__monitor, name, value)
+        return self.__monitor
+
+    def scheduler(self, **kwargs):
+        # the shared WakeScheduler for this vehicle; keyword arguments update
+        # its settings
+        if self.__scheduler is None:
+            self.__scheduler = WakeScheduler(self)
+        for name, value in kwargs.items():
+            setattr(self.__scheduler, name, value)
+        return self.__scheduler
+
+    def sleepManagerRequest(self, request):
+        # the car asks to keep the link up for a while; a scheduler holds the
+        # car awake for that long
+        if self.__debug:
+            print("Sleep manager request: {}".format(request))
+        if request.HasField("delaySleepRequest") and self.__scheduler is not None:
+            self.__scheduler.keepAwake(request.delaySleepRequest.delayTime_ms / 1000)
+
+    def state(self):
+        return self.__state
+
+    def recordHistory(self, capacity=4096):
+        # keeps every state change in a bounded StatusHistory
+        if self.__history is None or self.__history.capacity() != capacity:
+            self.__history = StatusHistory(capacity)
+        return self.__history
+
+    def history(self):
+        return self.__history
+
     def status(self):
-        return {
-            "locked": self.__locked,
-            "charge_port_open": self.__charge_port_open,
-            "front_driver_door_open": self.__front_driver_door_open,
-            "rear_driver_door_open": self.__rear_driver_door_open,
-            "front_passenger_door_open": self.__front_passenger_door_open,
-            "rear_passenger_door_open": self.__rear_passenger_door_open,
-            "rear_trunk_open": self.__rear_trunk_open,
-            "front_trunk_open": self.__front_trunk_open
-        }
+        return self.__status
 
     def is_debug(self):
         return self.__debug
@@ -189,10 +1556,39 @@ class Vehicle:
 
     def updateFile(self):
         file_name = self.file_name
-        # write the new lines back to the file
-        with open(file_name, "w") as f:
+        # write the new lines to a temporary file and swap it in, so other
+        # processes never read a half-written file
+        with open(file_name + ".tmp", "w") as f:
             f.write(
                 "{} {} {}".format(self.__peripheral.address(), self.__counter, self.__vehicle_key_str))
+        os.replace(file_name + ".tmp", file_name)
+        self.__file_stamp = self.__fileStamp()
+
+    def __fileStamp(self):
+        try:
+            stat = os.stat(self.file_name)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def counterFileMoved(self):
+        # whether another process has written the file since we last did,
+        # which means it reserved counters above ours
+        return self.__fileStamp() != self.__file_stamp
+
+    @contextmanager
+    def __lockFile(self):
+        # serializes access to the vehicle's file across processes; on
+        # platforms without fcntl only threads in this process are serialized
+        if fcntl is None:
+            yield
+            return
+        with open(self.file_name + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
 
     def address(self):
         return self.__peripheral.address()
@@ -203,9 +1599,30 @@ class Vehicle:
     def counter(self):
         return self.__counter
 
+    def counterBlock(self):
+        return self.__counter_block
+
     def setCounter(self, counter):
-        self.__counter = counter
-        self.updateFile()
+        with self.__file_lock, self.__lockFile():
+            self.__counter = counter
+            self.updateFile()
+
+    def reserveCounters(self, count, minimum=0):
+        # reserves a range of counters no other process sharing this file
+        # will use, and returns its first counter. The file only ever moves
+        # forward, and holds the end of the most recently reserved range.
+        # The car also needs counters to increase, so a process drops the
+        # rest of its range once another one has reserved past it; processes
+        # taking turns with one key pay a file lock per turn.
+        with self.__file_lock, self.__lockFile():
+            arr = self.getLineFromFile()
+            start = max(int(arr[1]), self.__counter, minimum)
+            if len(arr) > 2:
+                # keep whichever session key was stored last
+                self.__vehicle_key_str = arr[2]
+            self.__counter = start + count
+            self.updateFile()
+            return start
 
     def private_key(self):
         return self.__private_key
@@ -216,81 +1633,805 @@ class Vehicle:
         return self.__vehicle_key_str
 
     def setVehicleKeyStr(self, vehicle_key):
-        self.__vehicle_key_str = vehicle_key
-        self.updateFile()
+        with self.__file_lock, self.__lockFile():
+            self.__counter = max(
+                int(self.getLineFromFile()[1]), self.__counter)
+            self.__vehicle_key_str = vehicle_key
+            self.updateFile()
 
     def connect(self):
+        self.__closing = False
+        self.__chunk_size = None
+        self.__peripheral.set_callback_on_disconnected(
+            lambda: self.__onDisconnected())
         self.__peripheral.connect()
+        self.subscribe()
+        self.readVersion()
+
+    def subscribe(self):
         self.__peripheral.indicate(
-            TeslaUUIDs.SERVICE_UUID, TeslaUUIDs.CHAR_READ_UUID, lambda data: self.handle_notify(data))
+            TeslaUUIDs.SERVICE_UUID, TeslaUUIDs.CHAR_READ_UUID, lambda data: self.__onNotify(data))
+        if self.__inbox_thread is None:
+            self.__inbox_thread = threading.Thread(
+                target=self.__processInbox, daemon=True)
+            self.__inbox_thread.start()
+
+    def notificationQueue(self, size):
+        # how many status updates may wait for processing before the oldest
+        # are dropped; other notifications are always kept
+        self.__status_inbox = deque(self.__status_inbox, maxlen=size)
+
+    def __onNotify(self, data):
+        # runs on the BLE thread, so only copy the bytes and hand them off;
+        # parsing, key loading, replies and user callbacks run on the worker
+        data = bytes(data)
+        # after the length prefix, field 1 of FromVCSECMessage is vehicleStatus
+        if len(data) > 2 and data[2] == 0x0A:
+            inbox = self.__status_inbox
+            if len(inbox) == inbox.maxlen:
+                self.__notify_metrics["notify_dropped"] += 1
+                self.__notify_metrics["notify_dropped_status"] += 1
+        else:
+            inbox = self.__inbox
+        inbox.append((time.perf_counter(), data))
+        self.__traffic.received(len(data))
+        self.__notify_metrics["notify_received"] += 1
+        self.__inbox_ready.set()
+
+    def __processInbox(self):
+        metrics = self.__notify_metrics
+        while True:
+            # also wakes when the oldest reply is overdue, so its caller sees
+            # the timeout without waiting for more traffic
+            self.__inbox_ready.wait(self.__nextExpiry())
+            self.__inbox_ready.clear()
+            while True:
+                notification = self.__nextNotification()
+                if notification is None:
+                    break
+                queued, data = notification
+                latency = time.perf_counter() - queued
+                metrics["notify_latency_max"] = max(
+                    metrics["notify_latency_max"], latency)
+                metrics["notify_latency_avg"] += 0.125 * \
+                    (latency - metrics["notify_latency_avg"])
+                try:
+                    self.handle_notify(data)
+                except Exception as e:
+                    metrics["notify_errors"] += 1
+                    if self.__debug:
+                        print("Failed to handle notification: {}".format(e))
+            self.__expire(time.time())
+
+    def __nextNotification(self):
+        # the older head of the two queues, so notifications are handled in
+        # the order they arrived
+        statuses, replies = self.__status_inbox, self.__inbox
+        try:
+            if statuses and (not replies or statuses[0][0] <= replies[0][0]):
+                return statuses.popleft()
+            return replies.popleft()
+        except IndexError:
+            return None
 
     def disconnect(self):
+        self.__closing = True
         self.__peripheral.disconnect()
 
-    def whitelist(self):
-        msg = self.__service.whitelistMsg()
-        msg = bytes(msg)
-        self.__peripheral.write_command(
-            TeslaUUIDs.SERVICE_UUID, TeslaUUIDs.CHAR_WRITE_UUID, msg)
-        print("Sent whitelist request")
-        while True:
-            msg = self.__service.vehiclePublicKeyMsg()
-            msg = bytes(msg)
-            self.__peripheral.write_command(
-                TeslaUUIDs.SERVICE_UUID, TeslaUUIDs.CHAR_WRITE_UUID, msg)
-            print("Waiting for keycard to be tapped...")
-            time.sleep(2)  # I think time.sleep is not what I want
-            if (self.isAdded()):
-                print("Authorized successfully")
+    def autoReconnect(self, enabled=True, base_delay=0.5, max_delay=30.0, max_attempts=None, max_pending=16,
+                      max_replay_age=10.0):
+        # reconnects with jittered exponential backoff when the link drops
+        # unexpectedly, then replays idempotent commands that could not be
+        # sent, unless they were queued more than max_replay_age seconds ago
+        self.__auto_reconnect = enabled
+        self.__max_replay_age = max_replay_age
+        self.__reconnect_base_delay = base_delay
+        self.__reconnect_max_delay = max_delay
+        self.__reconnect_max_attempts = max_attempts
+        self.__pending = deque(self.__pending, maxlen=max_pending)
+
+    def onReconnect(self, func):
+        self.__onReconnect = func
+
+    def isReconnecting(self):
+        return self.__reconnecting
+
+    def __onDisconnected(self):
+        if self.__closing or not self.__auto_reconnect:
+            return
+        with self.__reconnect_lock:
+            if self.__reconnecting:
+                return
+            self.__reconnecting = True
+        threading.Thread(target=self.__reconnectLoop, daemon=True).start()
+
+    def __reconnectLoop(self):
+        attempt = 0
+        try:
+            while not self.__closing:
+                if self.__reconnect_max_attempts is not None and attempt >= self.__reconnect_max_attempts:
+                    print("Giving up reconnecting to " + str(self))
+                    return
+                delay = min(self.__reconnect_max_delay,
+                            self.__reconnect_base_delay * (2 ** attempt))
+                # full jitter keeps several clients from retrying in lockstep
+                time.sleep(random.uniform(delay / 2, delay))
+                attempt += 1
+                try:
+                    self.__peripheral.connect()
+                    self.__chunk_size = None
+                    self.subscribe()
+                    # the car may have been updated while we were away
+                    self.readVersion()
+                except Exception as e:
+                    if self.__debug:
+                        print("Reconnect attempt {} failed: {}".format(attempt, e))
+                    continue
                 break
+        finally:
+            with self.__reconnect_lock:
+                self.__reconnecting = False
+        if self.__closing or not self.isConnected():
+            return
+        if self.__debug:
+            print("Reconnected after {} attempt(s)".format(attempt))
+        self.__replayPending()
+        if self.__onReconnect is not None:
+            self.__onReconnect(self)
+
+    def __replayPending(self):
+        # messages are rebuilt rather than resent, so every replayed command
+        # is signed with a fresh counter
+        for _ in range(len(self.__pending)):
+            if self.__reconnecting:
+                break
+            build, queued, future = self.__pending.popleft()
+            # a caller that already gave up, e.g. on a reply timeout, no
+            # longer waits for the reply and must not get the command sent
+            if future is not None and future.done():
+                if self.__debug:
+                    print("Dropping command whose caller gave up")
+                continue
+            # an unlock asked for minutes ago should not fire now
+            if self.__max_replay_age is not None and time.time() - queued > self.__max_replay_age:
+                if self.__debug:
+                    print("Dropping command queued {:.1f}s ago".format(time.time() - queued))
+                continue
+            self.__send(build, idempotent=True, queued=queued, future=future)
+
+    def __send(self, build, idempotent=False, priority=PRIORITY_AUTOMATION, deadline=None, queued=None,
+               future=None):
+        # future is the caller's, if it waits for a reply; a queued frame is
+        # only replayed while it is pending
+        if queued is None:
+            queued = time.time()
+        if self.__reconnecting and idempotent:
+            self.__pending.append((build, queued, future))
+            return
+        # signing and writing in one queue slot keeps frames on the wire in
+        # counter order, which the car requires
+        with self.__send_queue.slot(priority, deadline):
+            try:
+                self.__write(bytes(build()))
+            except Exception:
+                if not (self.__auto_reconnect and idempotent) or self.__closing:
+                    raise
+                self.__pending.append((build, queued, future))
+                self.__onDisconnected()
+
+    def __write(self, msg):
+        # frames longer than one ATT payload are split across writes; the
+        # length prefix lets the car reassemble them
+        self.__traffic.take()
+        chunk = self.__chunkSize()
+        for offset in range(0, len(msg), chunk):
+            self.__peripheral.write_command(
+                TeslaUUIDs.SERVICE_UUID, TeslaUUIDs.CHAR_WRITE_UUID, msg[offset:offset + chunk])
+        self.__traffic.sent(len(msg), (len(msg) + chunk - 1) // chunk)
 
-    def unlock(self):
-        msg = self.__service.unlockMsg()
-        msg = bytes(msg)
-        self.__peripheral.write_command(
-            TeslaUUIDs.SERVICE_UUID, TeslaUUIDs.CHAR_WRITE_UUID, msg)
+    def rateLimit(self, rate=None, burst=8):
+        # at most rate messages per second to this car, in bursts of up to
+        # burst; None removes the limit
+        self.__traffic.limit(rate, burst)
 
-    def lock(self):
-        msg = self.__service.lockMsg()
-        msg = bytes(msg)
-        self.__peripheral.write_command(
-            TeslaUUIDs.SERVICE_UUID, TeslaUUIDs.CHAR_WRITE_UUID, msg)
+    def stats(self):
+        return self.__traffic.stats()
 
-    def open_trunk(self):
-        msg = self.__service.openTrunkMsg()
-        msg = bytes(msg)
-        self.__peripheral.write_command(
-            TeslaUUIDs.SERVICE_UUID, TeslaUUIDs.CHAR_WRITE_UUID, msg)
+    def __chunkSize(self):
+        if self.__chunk_size is None:
+            try:
+                self.__chunk_size = max(20, self.__peripheral.mtu() - 3)
+            except Exception:
+                self.__chunk_size = 20
+        return self.__chunk_size
+
+    def __command(self, build, idempotent=False, priority=PRIORITY_INTERACTIVE, future=None):
+        # sends an action that changes the car's state; status is polled more
+        # often for a while afterwards
+        self.__last_command_time = time.time()
+        self.__send(build, idempotent, priority, future=future)
+        if self.__monitor is not None:
+            self.__monitor.poke()
+
+    def __request(self, build, idempotent=False, timeout=None, priority=PRIORITY_INTERACTIVE):
+        # sends a command and returns a Future resolved by the car's
+        # commandStatus reply; replies are matched to requests in order
+        future = Future()
+        entry = _AwaitedReply(future, time.time() + self.__replyTimeout(timeout), build, idempotent)
+        self.__awaiting.append(entry)
+        self.__inbox_ready.set()
+        try:
+            self.__command(entry.frame, idempotent, priority, future)
+        except Exception as e:
+            self.__abandon(future, entry, e)
+            return future
+        self.__sentAt(future)
+        return future
+
+    ###########################       ROUND TRIP TIME       #############################
+
+    def rtt(self):
+        return self.__rtt
+
+    def replyTimeout(self):
+        # how long to wait for a reply: the estimator's timeout, or its
+        # maximum while the car sleeps, since waking adds seconds
+        if self.__state is not None and self.__state.isAsleep():
+            return self.__rtt.maximum
+        return self.__rtt.timeout()
+
+    def __replyTimeout(self, timeout):
+        return self.replyTimeout() if timeout is None else timeout
+
+    def __sentAt(self, future):
+        # a reply may already have arrived on another thread
+        if not future.done():
+            self.__sent_at[future] = time.perf_counter()
+
+    def __rttSample(self, future):
+        sent = self.__sent_at.pop(future, None)
+        if sent is not None:
+            self.__rtt.sample(time.perf_counter() - sent)
+
+    def waitForSession(self, timeout=None):
+        # waits for the car's session info, which only arrives once our key
+        # is on its whitelist; returns whether the key is added
+        if not self.isAdded():
+            self.__session_ready.wait(timeout)
+        return self.isAdded()
+
+    def sessionLoaded(self):
+        self.__session_ready.set()
+
+    def __forget(self, entry):
+        try:
+            self.__awaiting.remove(entry)
+        except ValueError:
+            pass
+
+    def __expireAwaiting(self, now):
+        # requests the car never answered would otherwise take the replies
+        # meant for later ones
+        while self.__awaiting and self.__awaiting[0].deadline < now:
+            future = self.__awaiting.popleft().future
+            self.__sent_at.pop(future, None)
+            self.__rtt.backoff()
+            if not future.done():
+                future.set_exception(TimeoutError("No reply from vehicle"))
+
+    def __expireInflight(self, key):
+        # called with __inflight_lock held; returns the future to fail once
+        # the lock is released, or None if it was answered
+        future, _ = self.__inflight.pop(key)
+        if future.done():
+            return None
+        waiters = self.__waiters.get(key)
+        if waiters is not None and future in waiters:
+            waiters.remove(future)
+        return future
+
+    def __timedOut(self, futures):
+        for future in futures:
+            self.__rtt.backoff()
+            if not future.done():
+                future.set_exception(TimeoutError("No reply from vehicle"))
+
+    def __expire(self, now):
+        self.__expireAwaiting(now)
+        expired = []
+        with self.__inflight_lock:
+            for key, inflight in list(self.__inflight.items()):
+                if inflight[0].done() or inflight[1] < now:
+                    future = self.__expireInflight(key)
+                    if future is not None:
+                        expired.append(future)
+        self.__timedOut(expired)
+
+    def __addWaiter(self, key, future):
+        with self.__inflight_lock:
+            self.__waiters.setdefault(key, []).append(future)
+
+    def __takeWaiters(self, key):
+        with self.__inflight_lock:
+            return self.__waiters.pop(key, [])
+
+    def __nextExpiry(self):
+        # seconds until the next reply is overdue, or None if none is awaited
+        deadlines = [inflight[1] for inflight in list(self.__inflight.values())
+                     if not inflight[0].done()]
+        try:
+            deadlines.append(self.__awaiting[0].deadline)
+        except IndexError:
+            pass
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.time())
+
+    def counterRejected(self, status, rejected):
+        # The car refused a message's counter. rejected is (message, attempts)
+        # for the signed message with the counter the car reported, if known.
+        # A command is re-signed only if it is safe to repeat; otherwise its
+        # future fails. Returns True if a message was sent again.
+        self.__expireAwaiting(time.time())
+        counter = status.signedMessageStatus.counter
+        entry = None
+        for candidate in self.__awaiting:
+            if candidate.counter == counter:
+                entry = candidate
+                break
+        if entry is None and rejected is not None:
+            # a signed message not answered by commandStatus, such as an
+            # information request; those are safe to repeat
+            message, attempts = rejected
+            if not (message.HasField("InformationRequest") or message.HasField("authenticationResponse")):
+                return False
+            if attempts >= 2:
+                return False
+            self.resend(message, attempts + 1)
+            return True
+        if entry is None:
+            # The counter does not name the message. Replies come in order,
+            # but the fault may belong to a status poll, an information
+            # request or an auth response, so the oldest command is only
+            # blamed if every signed frame that may still be answered is a
+            # command; otherwise it is left to time out.
+            if not self.__awaiting:
+                return False
+            tracked = {candidate.counter for candidate in self.__awaiting}
+            if not self.__service.signedSince(time.time() - self.__rtt.maximum) <= tracked:
+                return False
+            entry = self.__awaiting[0]
+        self.__forget(entry)
+        # the reply to a retransmitted message is not a round trip sample
+        self.__sent_at.pop(entry.future, None)
+        if not entry.idempotent or entry.attempts >= 2:
+            if not entry.future.done():
+                entry.future.set_exception(CommandError(status))
+            return False
+        entry.attempts += 1
+        # the retry goes out after the frames already in flight, so its
+        # reply comes after theirs
+        self.__awaiting.append(entry)
+        try:
+            self.__send(entry.frame, idempotent=True, priority=PRIORITY_INTERACTIVE, future=entry.future)
+        except Exception as e:
+            self.__forget(entry)
+            if not entry.future.done():
+                entry.future.set_exception(e)
+            return False
+        return True
 
-    def open_frunk(self):
-        msg = self.__service.openFrunkMsg()
-        msg = bytes(msg)
-        self.__peripheral.write_command(
-            TeslaUUIDs.SERVICE_UUID, TeslaUUIDs.CHAR_WRITE_UUID, msg)
+    def commandStatus(self, status):
+        now = time.time()
+        # requests the car never answered would otherwise take the replies
+        # meant for later ones
+        self.__expireAwaiting(now)
+        if status.operationStatus == VCSEC_pb2.OPERATIONSTATUS_WAIT:
+            return
+        try:
+            future = self.__awaiting.popleft().future
+        except IndexError:
+            return
+        self.__rttSample(future)
+        if status.operationStatus == VCSEC_pb2.OPERATIONSTATUS_ERROR:
+            future.set_exception(CommandError(status))
+        else:
+            future.set_result(status)
+
+    def move_closures(self, moves, timeout=None):
+        # moves several closures in one round trip, e.g.
+        # move_closures({"frontTrunk": "open", "chargePort": "open"}).
+        # Keys are ClosureMoveRequest fields, values a ClosureMoveType_E or
+        # one of "open", "close", "move" and "stop".
+        request = self.__closureMoves(moves)
+        return self.__request(
+            lambda: self.__service.closureMoveMsg(request), timeout=timeout)
+
+    def __closureMoves(self, moves):
+        request = {}
+        for closure, move in moves.items():
+            if closure not in VehicleState.CLOSURES:
+                raise ValueError("Unknown closure: {}".format(closure))
+            if isinstance(move, str):
+                move = VCSEC_pb2.ClosureMoveType_E.Value(
+                    "CLOSURE_MOVE_TYPE_" + move.upper())
+            request[closure] = move
+        return request
+
+    def batch(self):
+        return CommandBatch(self)
+
+    def __batchCommand(self, name, args):
+        # (builder, whether the car answers with a commandStatus)
+        service = self.__service
+        if name == "move_closures":
+            moves = self.__closureMoves(args[0])
+            return lambda: service.closureMoveMsg(moves), True
+        if name == "vehicle_status":
+            return service.vehicleStatusMsg, False
+        return {
+            "unlock": service.unlockMsg,
+            "lock": service.lockMsg,
+            "open_trunk": service.openTrunkMsg,
+            "open_frunk": service.openFrunkMsg,
+            "open_charge_port": service.openChargePortMsg,
+            "close_charge_port": service.closeChargePortMsg,
+        }[name], True
+
+    def runBatch(self, commands, window=4, timeout=None):
+        # Signs and writes the commands of a CommandBatch in order, `window`
+        # at a time: each window is signed in one pass and written back to
+        # back, then its replies are awaited before the next one. Returns a
+        # Future per command as soon as the last window is written.
+        timeout = self.__replyTimeout(timeout)
+        # an invalid command raises here, before any waiter is registered
+        commands = [(name, self.__batchCommand(name, args)) for name, args in commands]
+        futures = []
+        for start in range(0, len(commands), window):
+            group = commands[start:start + window]
+            with self.__send_queue.slot(PRIORITY_AUTOMATION):
+                entries = []
+                for name, (build, commanded) in group:
+                    future = Future()
+                    if commanded:
+                        entry = _AwaitedReply(future, time.time() + timeout, build, name in self.IDEMPOTENT)
+                        self.__awaiting.append(entry)
+                    else:
+                        entry = None
+                        self.__addWaiter("status", future)
+                    futures.append(future)
+                    entries.append((future, entry, build))
+                self.__inbox_ready.set()
+                frames = []
+                for future, entry, build in entries:
+                    try:
+                        frames.append(entry.frame() if entry is not None else bytes(build()))
+                    except Exception as e:
+                        self.__abandon(future, entry, e)
+                        frames.append(None)
+                self.__last_command_time = time.time()
+                for frame, (future, entry, build) in zip(frames, entries):
+                    if frame is None:
+                        continue
+                    try:
+                        self.__write(frame)
+                    except Exception as e:
+                        self.__abandon(future, entry, e)
+                        continue
+                    if entry is not None:
+                        self.__sentAt(future)
+                    else:
+                        self.__status_sent = time.perf_counter()
+            if self.__monitor is not None:
+                self.__monitor.poke()
+            if start + window < len(commands):
+                wait([f for f, _, _ in entries], timeout=timeout)
+        return futures
+
+    def __abandon(self, future, entry, error):
+        if entry is not None:
+            self.__forget(entry)
+        else:
+            with self.__inflight_lock:
+                for waiters in self.__waiters.values():
+                    if future in waiters:
+                        waiters.remove(future)
+        if not future.done():
+            future.set_exception(error)
 
-    def open_charge_port(self):
-        msg = self.__service.openChargePortMsg()
-        msg = bytes(msg)
-        self.__peripheral.write_command(
-            TeslaUUIDs.SERVICE_UUID, TeslaUUIDs.CHAR_WRITE_UUID, msg)
+    def requestWhitelist(self):
+        # asks the car to add our key; it is added once a keycard is tapped
+        self.__send(self.__service.whitelistMsg)
 
-    def close_charge_port(self):
-        msg = self.__service.closeChargePortMsg()
-        msg = bytes(msg)
-        self.__peripheral.write_command(
-            TeslaUUIDs.SERVICE_UUID, TeslaUUIDs.CHAR_WRITE_UUID, msg)
+    def requestSessionInfo(self):
+        # the car only answers once our key is on its whitelist
+        self.__send(self.__service.vehiclePublicKeyMsg)
 
-    def vehicle_status(self):
-        msg = self.__service.vehicleStatusMsg()
-        msg = bytes(msg)
-        self.__peripheral.write_command(
-            TeslaUUIDs.SERVICE_UUID, TeslaUUIDs.CHAR_WRITE_UUID, msg)
+    def whitelist(self):
+        self.requestWhitelist()
+        print("Sent whitelist request")
+        while True:
+            self.requestSessionInfo()
+            print("Waiting for keycard to be tapped...")
+            if self.waitForSession(self.replyTimeout()):
+                print("Authorized successfully")
+                break
 
-    def vehicle_info(self):
-        msg = self.__service.vehicleInfoMsg()
-        msg = bytes(msg)
-        self.__peripheral.write_command(
-            TeslaUUIDs.SERVICE_UUID, TeslaUUIDs.CHAR_WRITE_UUID, msg)
+    # commands marked idempotent are safe to replay after a reconnect or a
+    # rejected counter; the trunk and frunk actions may toggle a powered
+    # closure, so they are not
+    IDEMPOTENT = frozenset(("unlock", "lock", "open_charge_port", "close_charge_port"))
+
+    # Each returns a Future resolved by the car's commandStatus, so its reply
+    # is never taken for that of a later command.
+
+    def unlock(self, timeout=None):
+        return self.__request(self.__service.unlockMsg, True, timeout)
+
+    def lock(self, timeout=None):
+        return self.__request(self.__service.lockMsg, True, timeout)
+
+    def open_trunk(self, timeout=None):
+        return self.__request(self.__service.openTrunkMsg, timeout=timeout)
+
+    def open_frunk(self, timeout=None):
+        return self.__request(self.__service.openFrunkMsg, timeout=timeout)
+
+    def open_charge_port(self, timeout=None):
+        return self.__request(self.__service.openChargePortMsg, True, timeout)
+
+    def close_charge_port(self, timeout=None):
+        return self.__request(self.__service.closeChargePortMsg, True, timeout)
+
+    # Information requests are single-flight: callers asking while the same
+    # request is in flight share its Future instead of sending another signed
+    # message. With max_age, a result that recent is returned without sending.
+
+    def vehicle_status(self, max_age=None, timeout=None, priority=PRIORITY_AUTOMATION, deadline=None):
+        # returns a Future resolved with the VehicleState
+        return self.__coalesce("status", self.__service.vehicleStatusMsg,
+                               self.__state, self.__last_status_time, max_age, timeout, priority, deadline)
+
+    def vehicle_info(self, max_age=None, timeout=None):
+        # returns a Future resolved with the VehicleInfo message
+        return self.__coalesce("info", self.__service.vehicleInfoMsg,
+                               self.__vehicle_info, self.__vehicle_info_time, max_age, timeout)
+
+    def __coalesce(self, key, build, last, last_time, max_age, timeout,
+                   priority=PRIORITY_AUTOMATION, deadline=None):
+        timeout = self.__replyTimeout(timeout)
+        if max_age is not None and last is not None and time.time() - last_time <= max_age:
+            self.__request_metrics["fresh_hits"] += 1
+            future = Future()
+            future.set_result(last)
+            return future
+        expired = None
+        with self.__inflight_lock:
+            inflight = self.__inflight.get(key)
+            if inflight is not None:
+                if not inflight[0].done() and time.time() < inflight[1]:
+                    self.__request_metrics["coalesced_requests"] += 1
+                    return inflight[0]
+                # answered, or the car never answered; then ask again
+                expired = self.__expireInflight(key)
+            future = Future()
+            self.__inflight[key] = (future, time.time() + timeout)
+            self.__waiters.setdefault(key, []).append(future)
+        if expired is not None:
+            self.__timedOut([expired])
+        self.__inbox_ready.set()
+        self.__request_metrics["information_requests"] += 1
+        try:
+            self.__send(build, True, priority, deadline, future=future)
+        except Exception as e:
+            self.__abandon(future, None, e)
+            raise
+        if key == "status" and not future.done():
+            self.__status_sent = time.perf_counter()
+        return future
+
+    def vehicle_capabilities(self, max_age=None, timeout=None):
+        # returns a Future resolved with the Capabilities message
+        return self.__coalesce("capabilities", self.__service.capabilitiesMsg,
+                               self.__capabilities, self.__capabilities_time, max_age, timeout)
+
+    def setVehicleInfo(self, info):
+        self.__vehicle_info = info
+        self.__vehicle_info_time = time.time()
+        self.__info_cache["vin"] = info.VIN
+        self.__saveInfoCache()
+        for future in self.__takeWaiters("info"):
+            future.set_result(info)
+
+    def setCapabilities(self, capabilities):
+        self.__capabilities = capabilities
+        self.__capabilities_time = time.time()
+        self.__info_cache["capabilities"] = {
+            "chargePortOpen": capabilities.chargePortOpen,
+            "chargePortClose": capabilities.chargePortClose,
+        }
+        self.__saveInfoCache()
+        for future in self.__takeWaiters("capabilities"):
+            future.set_result(capabilities)
+
+    def whitelist_info(self, max_age=None, timeout=None):
+        # returns a Future resolved with the WhitelistInfo message
+        return self.__coalesce("whitelist", self.__service.whitelistInfoMsg,
+                               self.__whitelist_info, self.__whitelist_info_time, max_age, timeout)
+
+    def whitelist_entry(self, slot, timeout=None):
+        # returns a Future resolved with the WhitelistEntryInfo of one slot
+        return self.__coalesce(("entry", slot), lambda: self.__service.whitelistEntryInfoMsg(slot),
+                               None, 0.0, None, timeout)
+
+    def setWhitelistInfo(self, info):
+        self.__whitelist_info = info
+        self.__whitelist_info_time = time.time()
+        for future in self.__takeWaiters("whitelist"):
+            future.set_result(info)
+
+    def setWhitelistEntry(self, entry):
+        for future in self.__takeWaiters(("entry", entry.slot)):
+            future.set_result(entry)
+
+    ###########################       KEY MANAGEMENT       #############################
+
+    def fetchWhitelist(self, timeout=None):
+        # Reads every key on the whitelist and returns {slot: WhitelistKey}.
+        # After the slot mask, all slots are requested back to back instead
+        # of one round trip each. The slot map is kept in the info cache.
+        timeout = self.__replyTimeout(timeout)
+        info = self.whitelist_info(timeout=timeout).result(timeout)
+        slots = [slot for slot in range(32) if info.slotMask >> slot & 1]
+        futures = [self.whitelist_entry(slot, timeout=timeout) for slot in slots]
+        keys = {}
+        for future in futures:
+            entry = future.result(timeout)
+            keys[entry.slot] = WhitelistKey(
+                entry.slot, entry.publicKey.PublicKeyRaw,
+                frozenset(entry.permissions), entry.metadataForKey.keyFormFactor)
+        self.__info_cache["whitelist"] = {
+            str(key.slot): {
+                "publicKey": binascii.hexlify(key.public_key).decode(),
+                "permissions": sorted(key.permissions),
+                "formFactor": key.form_factor,
+            } for key in keys.values()
+        }
+        self.__saveInfoCache()
+        return keys
+
+    def whitelistKeys(self):
+        # the slot map from the last fetchWhitelist, or None
+        whitelist = self.__info_cache.get("whitelist")
+        if whitelist is None:
+            return None
+        return {
+            int(slot): WhitelistKey(
+                int(slot), binascii.unhexlify(key["publicKey"]),
+                frozenset(key["permissions"]), key["formFactor"])
+            for slot, key in whitelist.items()
+        }
+
+    def applyWhitelist(self, desired, form_factor=VCSEC_pb2.KEY_FORM_FACTOR_ANDROID_DEVICE, timeout=None):
+        # Brings the whitelist in line with desired, a dict of public key
+        # bytes to the permissions that key should have. Keys missing from
+        # desired are removed, except our own. All operations are sent back to
+        # back; returns a list of (operation, public key, Future).
+        current = self.whitelistKeys()
+        if current is None:
+            current = self.fetchWhitelist(timeout)
+        current = {key.public_key: key.permissions for key in current.values()}
+        own_key = self.__service.getPublicKey()
+        operations = []
+        for public_key, permissions in current.items():
+            if public_key not in desired and public_key != own_key:
+                operations.append(("remove", public_key, ()))
+        for public_key, permissions in desired.items():
+            permissions = frozenset(permissions)
+            if public_key not in current:
+                operations.append(("add", public_key, permissions))
+                continue
+            granted = permissions - current[public_key]
+            revoked = current[public_key] - permissions
+            if granted:
+                operations.append(("addPermissions", public_key, granted))
+            if revoked:
+                operations.append(("removePermissions", public_key, revoked))
+        results = []
+        for operation, public_key, permissions in operations:
+            future = self.__request(
+                lambda o=operation, k=public_key, p=permissions: self.__service.whitelistOperationMsg(
+                    o, k, sorted(p), form_factor),
+                timeout=timeout)
+            future.add_done_callback(self.__whitelistChanged)
+            results.append((operation, public_key, future))
+        return results
+
+    def __whitelistChanged(self, future):
+        # slots are assigned by the car, so the cached map is refetched
+        # rather than patched
+        if future.exception() is None and self.__info_cache.pop("whitelist", None) is not None:
+            self.__saveInfoCache()
+
+    ###########################       INFO CACHE       #############################
+
+    # The VIN, capabilities and version characteristic almost never change, so
+    # they are kept in .tesladata/<address>.json. The cache is keyed on the
+    # version characteristic, read on every connect, and is dropped when the
+    # version changes, e.g. after a firmware update. Until a version has been
+    # read nothing cached is served, and nothing fetched is saved.
+
+    def vin(self):
+        return self.__info_cache.get("vin")
+
+    def capabilities(self):
+        capabilities = self.__info_cache.get("capabilities")
+        if capabilities is None:
+            return None
+        return VCSEC_pb2.Capabilities(**capabilities)
+
+    def version(self):
+        version = self.__info_cache.get("version")
+        return None if version is None else binascii.unhexlify(version)
+
+    def fetchInfo(self, timeout=None):
+        # returns a Future resolved once the VIN and capabilities are known,
+        # only asking the car for what is not cached
+        futures = []
+        if self.vin() is None:
+            futures.append(self.vehicle_info(timeout=timeout))
+        if self.capabilities() is None:
+            futures.append(self.vehicle_capabilities(timeout=timeout))
+        future = Future()
+
+        def done(_):
+            if future.done() or not all(f.done() for f in futures):
+                return
+            for f in futures:
+                if f.exception() is not None:
+                    future.set_exception(f.exception())
+                    return
+            future.set_result((self.vin(), self.capabilities()))
+
+        if not futures:
+            future.set_result((self.vin(), self.capabilities()))
+        for f in futures:
+            f.add_done_callback(done)
+        return future
+
+    def readVersion(self):
+        try:
+            version = bytes(self.__peripheral.read(
+                TeslaUUIDs.SERVICE_UUID, TeslaUUIDs.CHAR_VERSION_UUID))
+        except Exception as e:
+            if self.__debug:
+                print("Could not read version: {}".format(e))
+            # the firmware may have changed since the cache was written
+            self.__info_cache = {}
+            return None
+        version_str = binascii.hexlify(version).decode()
+        cache = self.__loadInfoCache()
+        if cache.get("version") == version_str:
+            self.__info_cache = cache
+        else:
+            self.__info_cache = {"version": version_str}
+            self.__saveInfoCache()
+        return version
+
+    def __loadInfoCache(self):
+        try:
+            with open(self.__info_file, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def __saveInfoCache(self):
+        if "version" not in self.__info_cache:
+            return
+        with self.__file_lock:
+            with open(self.__info_file + ".tmp", "w") as f:
+                json.dump(self.__info_cache, f)
+            os.replace(self.__info_file + ".tmp", self.__info_file)
 
     def isAdded(self):
         return self.__service.isAdded()
@@ -299,21 +2440,123 @@ class Vehicle:
         return self.__peripheral.is_connected()
 
     def handle_notify(self, data):
+        self.__traffic.handled()
         self.__service.handle_notify(data)
 
+    def presign(self, *actions):
+        # keeps signed frames for the given RKE actions (unlock and lock by
+        # default) ready, so sending them only costs the BLE write
+        if actions:
+            self.__service.presign(actions)
+        else:
+            self.__service.presign()
+
+    def resend(self, message, attempts=2):
+        self.__send(lambda: self.__service.signedToMsg(message, attempts), idempotent=True,
+                    priority=PRIORITY_INTERACTIVE)
+
+    def metrics(self):
+        metrics = self.__service.metrics()
+        metrics.update(self.__notify_metrics)
+        metrics.update(self.__request_metrics)
+        metrics.update(self.__auth_metrics)
+        metrics.update(self.__send_queue.metrics())
+        metrics.update(self.__rtt.metrics())
+        metrics["notify_queue_depth"] = len(self.__inbox) + len(self.__status_inbox)
+        return metrics
+
+    ###########################       AUTHENTICATION       #############################
+
+    # The car asks for authentication repeatedly while a key is nearby. The
+    # requests are handed to a responder thread, which keeps only the oldest
+    # unanswered request per level and skips levels answered within
+    # authInterval, so bursts cost one reply. The service keeps a signed
+    # response per level ready, so answering is usually just the write.
+
+    def authInterval(self, seconds):
+        self.__auth_interval = seconds
+
     def authenticationRequest(self, requested_level):
-        msg = self.__service.authenticationRequestMsg(requested_level)
-        msg = bytes(msg)
-        self.__peripheral.write_command(
-            TeslaUUIDs.SERVICE_UUID, TeslaUUIDs.CHAR_WRITE_UUID, msg)
+        if requested_level not in self.__auth_requests:
+            self.__auth_requests[requested_level] = time.perf_counter()
+        self.__auth_metrics["auth_requests"] += 1
+        if self.__auth_thread is None:
+            self.__auth_thread = threading.Thread(
+                target=self.__authResponder, daemon=True)
+            self.__auth_thread.start()
+        self.__auth_ready.set()
+
+    def __authResponder(self):
+        metrics = self.__auth_metrics
+        while True:
+            self.__auth_ready.wait()
+            self.__auth_ready.clear()
+            for level in list(self.__auth_requests):
+                received = self.__auth_requests.pop(level, None)
+                if received is None:
+                    continue
+                if received - self.__auth_answered.get(level, float("-inf")) < self.__auth_interval:
+                    metrics["auth_suppressed"] += 1
+                    continue
+                distance = self.estimatedDistance()
+                try:
+                    self.__send(lambda: self.__service.authenticationRequestMsg(level, distance),
+                                priority=PRIORITY_INTERACTIVE)
+                except Exception as e:
+                    if self.__debug:
+                        print("Failed to answer authentication request: {}".format(e))
+                    continue
+                now = time.perf_counter()
+                self.__auth_answered[level] = now
+                metrics["auth_responses"] += 1
+                latency = now - received
+                metrics["auth_latency_max"] = max(metrics["auth_latency_max"], latency)
+                metrics["auth_latency_avg"] += 0.125 * (latency - metrics["auth_latency_avg"])
+
+    def estimatedDistance(self, measured_power=-59, path_loss=2.0):
+        # distance in centimetres from the connection RSSI with the
+        # log-distance path loss model; measured_power is the RSSI at 1 m
+        try:
+            rssi = self.__peripheral.rssi()
+        except Exception:
+            return None
+        if not rssi:
+            return None
+        return int(100 * 10 ** ((measured_power - rssi) / (10 * path_loss)))
 
 
 class TeslaMsgService:
     def __init__(self, vehicle):
         self.__vehicle = vehicle
-        self.setCounter(vehicle.counter())
+        self.__counter_lock = threading.Lock()
+        # counters are handed out from a block reserved in the vehicle's file,
+        # so the file is only locked and written once per block
+        self.__block = (itertools.count(0), 0)
+        self.__last_counter = vehicle.counter() - 1
         self.vehicle_key = None
+        # (vehicle key, shared key, cipher), replaced as a whole so readers on
+        # other threads never see a half-loaded session
+        self.__session = None
+        self.__metrics = {
+            "counter_resyncs": 0,
+            "counter_retries": 0,
+            "presign_hits": 0,
+            "presign_misses": 0,
+        }
+        self.__presign_actions = ()
+        # authentication level -> the ("auth", level, distance) key of the
+        # response kept ready for it
+        self.__auth_levels = {}
+        self.__presigned = {}
+        self.__presign_lock = threading.Lock()
+        self.__presign_wake = threading.Event()
+        self.__presign_thread = None
+        self.__emitted = -1
+        # counter -> (message, attempts) for recently signed messages, so a
+        # message whose counter the car rejects can be found again
+        self.__signed = OrderedDict()
         self.private_key = vehicle.private_key()
+        self.__key_id = None
         vehicle_key_str = vehicle.vehicle_key_str()
         if vehicle_key_str is not None:
             self.loadEphemeralKey(vehicle_key_str)
@@ -343,11 +2586,14 @@ class TeslaMsgService:
         return public_key_bytes
 
     def getKeyId(self):
+        if self.__key_id is not None:
+            return self.__key_id
         public_key = self.getPublicKey()
 
         digest = hashes.Hash(hashes.SHA1())
         digest.update(public_key)
-        return digest.finalize()[:4]
+        self.__key_id = digest.finalize()[:4]
+        return self.__key_id
 
     def getSharedKey(self):
         # creates sha1 hasher for creating shared key
@@ -360,16 +2606,37 @@ class TeslaMsgService:
         # and the first 16 bytes of the hash will be our final shared key
         return hasher.finalize()[:16]
 
-    def signedToMsg(self, message):
-        if not self.isAdded():
+    def signedToMsg(self, message, attempts=1):
+        session = self.__session
+        if session is None:
             raise Exception('Car\'s ephermeral key not yet loaded!')
-        shared_secret = self.getSharedKey()
-        encryptor = AESGCM(shared_secret)
+        counter = self.reserveCounter()
+        self.__remember(counter, message, attempts)
+        frame = self.signWithCounter(session, message, counter)
+        self.__emit(counter)
+        return frame
+
+    def __remember(self, counter, message, attempts=1):
+        signed = self.__signed
+        signed[counter] = (message, attempts, time.time())
+        while len(signed) > 64:
+            try:
+                signed.popitem(last=False)
+            except KeyError:
+                break
+
+    def signedSince(self, since):
+        # counters of the messages signed at or after since
+        return {counter for counter, (_, _, signed_at) in tuple(self.__signed.items())
+                if signed_at >= since}
+
+    def signWithCounter(self, session, message, counter):
+        encryptor = session[2]
         nonce = bytearray()
-        nonce.append((self.counter >> 24) & 255)
-        nonce.append((self.counter >> 16) & 255)
-        nonce.append((self.counter >> 8) & 255)
-        nonce.append(self.counter & 255)
+        nonce.append((counter >> 24) & 255)
+        nonce.append((counter >> 16) & 255)
+        nonce.append((counter >> 8) & 255)
+        nonce.append(counter & 255)
 
         umsg_to = VCSEC_pb2.ToVCSECMessage()
         umsg_to.unsignedMessage.CopyFrom(message)
@@ -384,11 +2651,10 @@ class TeslaMsgService:
         signed_msg = msg.signedMessage
         signed_msg.protobufMessageAsBytes = encrypted_msg[:-16]
         signed_msg.signatureType = VCSEC_pb2.SIGNATURE_TYPE_AES_GCM
-        signed_msg.counter = self.counter
+        signed_msg.counter = counter
         signed_msg.signature = encrypted_msg[-16:]
         signed_msg.keyId = self.getKeyId()
 
-        self.setCounter(self.counter + 1)
         return self.prependLength(msg.SerializeToString())
 
     def unsignedToMsg(self, message):
@@ -406,19 +2672,158 @@ class TeslaMsgService:
             key = binascii.unhexlify(key)
         self.ephemeral_str = binascii.hexlify(key)
         curve = ec.SECP256R1()
-        self.vehicle_key = ec.EllipticCurvePublicKey.from_encoded_point(
+        vehicle_key = ec.EllipticCurvePublicKey.from_encoded_point(
             curve, key)
+        self.vehicle_key = vehicle_key
+        shared_key = self.getSharedKey()
+        self.__session = (vehicle_key, shared_key,
+                          ShortNonceAESGCM(shared_key))
         self.__vehicle.setVehicleKeyStr(self.ephemeral_str)
+        if self.__presign_actions or self.__auth_levels:
+            # frames signed with the old session key are useless now
+            self.__presign_wake.set()
+
+    @property
+    def counter(self):
+        # the next counter that will be handed out
+        return self.__last_counter + 1
+
+    def reserveCounter(self):
+        while True:
+            # next() on itertools.count is atomic under the GIL, so concurrent
+            # callers always get distinct counters without taking a lock
+            counters, limit = self.__block
+            counter = next(counters)
+            # a counter below another process's reservation would be
+            # rejected by the car once that process has sent
+            if counter < limit and not self.__vehicle.counterFileMoved():
+                self.__last_counter = counter
+                return counter
+            with self.__counter_lock:
+                if self.__block[0] is counters:
+                    self.__refillBlock()
+
+    def __refillBlock(self, minimum=0):
+        size = self.__vehicle.counterBlock()
+        start = self.__vehicle.reserveCounters(size, minimum)
+        self.__block = (itertools.count(start), start + size)
 
     def setCounter(self, counter):
-        self.counter = counter
-        self.__vehicle.setCounter(counter)
+        with self.__counter_lock:
+            self.__vehicle.setCounter(counter)
+            self.__last_counter = counter - 1
+            self.__block = (itertools.count(0), 0)
+
+    def syncCounter(self, counter):
+        # the car reports the last counter it accepted, so ours must be ahead
+        with self.__counter_lock:
+            if counter < self.counter:
+                return False
+            self.__refillBlock(counter + 1)
+            self.__last_counter = counter
+        self.__emit(counter)
+        self.__metrics["counter_resyncs"] += 1
+        return True
+
+    ###########################       PRE-SIGNING       #############################
+
+    # Opt-in cache of signed RKE frames for the likely next commands, refilled
+    # in the background so sending one is just a BLE write. The car rejects a
+    # counter lower than one it has already seen, so a cached frame is only
+    # used while no higher counter has been sent and its session key is still
+    # current; otherwise it is dropped and re-signed. Authentication responses
+    # are kept the same way for every level the car has asked for.
+
+    def presign(self, actions=(VCSEC_pb2.RKE_ACTION_UNLOCK, VCSEC_pb2.RKE_ACTION_LOCK)):
+        self.__presign_actions = tuple(actions)
+        self.__startPresigning()
+
+    def __startPresigning(self):
+        if self.__presign_thread is None:
+            self.__presign_thread = threading.Thread(
+                target=self.__presignLoop, daemon=True)
+            self.__presign_thread.start()
+        self.__presign_wake.set()
+
+    def stopPresigning(self):
+        # authentication responses are still kept ready
+        actions = self.__presign_actions
+        self.__presign_actions = ()
+        with self.__presign_lock:
+            for action in actions:
+                self.__presigned.pop(action, None)
+        self.__presign_wake.set()
+
+    def __emit(self, counter):
+        # records the highest counter handed out for sending
+        if not self.__presign_actions and not self.__auth_levels:
+            self.__emitted = max(self.__emitted, counter)
+            return
+        with self.__presign_lock:
+            self.__emitted = max(self.__emitted, counter)
+        self.__presign_wake.set()
+
+    def __isFresh(self, entry):
+        session, counter, message, frame = entry
+        return session is self.__session and counter > self.__emitted
+
+    def __takePresigned(self, action):
+        with self.__presign_lock:
+            entry = self.__presigned.pop(action, None)
+            if entry is None or not self.__isFresh(entry):
+                self.__metrics["presign_misses"] += 1
+                entry = None
+            else:
+                self.__emitted = max(self.__emitted, entry[1])
+                self.__metrics["presign_hits"] += 1
+        self.__presign_wake.set()
+        if entry is None:
+            return None
+        self.__remember(entry[1], entry[2])
+        return entry[3]
+
+    def __presignWanted(self, key):
+        return key in self.__presign_actions or key in self.__auth_levels.values()
+
+    def __presignLoop(self):
+        while True:
+            self.__presign_wake.wait()
+            self.__presign_wake.clear()
+            for key in self.__presign_actions + tuple(self.__auth_levels.values()):
+                session = self.__session
+                if session is None:
+                    break
+                with self.__presign_lock:
+                    entry = self.__presigned.get(key)
+                    if entry is not None and self.__isFresh(entry):
+                        continue
+                if isinstance(key, tuple):
+                    message = self.__authenticationResponse(key[1], key[2])
+                else:
+                    message = VCSEC_pb2.UnsignedMessage()
+                    message.RKEAction = key
+                counter = self.reserveCounter()
+                frame = self.signWithCounter(session, message, counter)
+                with self.__presign_lock:
+                    if self.__presignWanted(key):
+                        self.__presigned[key] = (
+                            session, counter, message, frame)
+
+    def metrics(self):
+        return dict(self.__metrics)
 
     ###########################       PROCESS RESPONSES       #############################
 
     def handle_notify(self, data):
         # remove first two bytes (length)
         data = data[2:]
+        if not self.__vehicle.is_debug():
+            # status updates are by far the most common message, so decode
+            # them without building protobuf objects when possible
+            bits = decodeVehicleStatus(data)
+            if bits is not None:
+                self.__vehicle.setState(VehicleState(bits))
+                return True
         msg = VCSEC_pb2.FromVCSECMessage()
         msg.ParseFromString(data)
 
@@ -430,17 +2835,45 @@ class TeslaMsgService:
             key = msg.sessionInfo.publicKey
             self.loadEphemeralKey(key)
             print("Loaded ephemeral key")
+            self.syncCounter(msg.sessionInfo.counter)
+            self.__vehicle.sessionLoaded()
+        elif msg.HasField('commandStatus'):
+            self.handleCommandStatus(msg.commandStatus)
         elif msg.HasField('authenticationRequest'):
             self.__vehicle.authenticationRequest(
                 msg.authenticationRequest.requestedLevel)
         elif msg.HasField('vehicleStatus'):
             self.__vehicle.setStatus(msg.vehicleStatus)
+        elif msg.HasField('vehicleInfo'):
+            self.__vehicle.setVehicleInfo(msg.vehicleInfo)
+        elif msg.HasField('capabilities'):
+            self.__vehicle.setCapabilities(msg.capabilities)
+        elif msg.HasField('whitelistInfo'):
+            self.__vehicle.setWhitelistInfo(msg.whitelistInfo)
+        elif msg.HasField('whitelistEntryInfo'):
+            self.__vehicle.setWhitelistEntry(msg.whitelistEntryInfo)
+        elif msg.HasField('sleepManagerRequest'):
+            self.__vehicle.sleepManagerRequest(msg.sleepManagerRequest)
 
         # TODO: check if the message is signed
-        # TODO: get command status
         # TODO: do something with the message
         return True
 
+    def handleCommandStatus(self, status):
+        if (status.HasField('signedMessageStatus')
+                and status.signedMessageStatus.signedMessageInformation in COUNTER_FAULTS):
+            if self.__vehicle.is_debug():
+                print("Counter rejected by vehicle, resynchronizing")
+            rejected = self.__signed.pop(status.signedMessageStatus.counter, None)
+            if rejected is not None:
+                rejected = rejected[:2]
+            self.syncCounter(status.signedMessageStatus.counter)
+            if self.__vehicle.counterRejected(status, rejected):
+                # the retry will get its own status
+                self.__metrics["counter_retries"] += 1
+            return
+        self.__vehicle.commandStatus(status)
+
     ###########################       VEHICLE ACTIONS       #############################
 
     # These functions generate a message to perform a particular action, such
@@ -465,6 +2898,28 @@ class TeslaMsgService:
         msg2.signedMessage.protobufMessageAsBytes = msg.SerializeToString()
         return self.prependLength(msg2.SerializeToString())
 
+    # WhitelistOperation fields for the operations applyWhitelist uses
+    WHITELIST_OPERATIONS = {
+        "add": "addKeyToWhitelistAndAddPermissions",
+        "remove": "removePublicKeyFromWhitelist",
+        "addPermissions": "addPermissionsToPublicKey",
+        "removePermissions": "removePermissionsFromPublicKey",
+    }
+
+    def whitelistOperationMsg(self, operation, public_key, permissions=(), form_factor=None):
+        # changes another key on the whitelist, signed with our key
+        msg = VCSEC_pb2.UnsignedMessage()
+        whitelist_operation = msg.WhitelistOperation
+        field = getattr(whitelist_operation, self.WHITELIST_OPERATIONS[operation])
+        if operation == "remove":
+            field.PublicKeyRaw = public_key
+        else:
+            field.key.PublicKeyRaw = public_key
+            field.permission.extend(permissions)
+        if operation == "add" and form_factor is not None:
+            whitelist_operation.metadataForKey.keyFormFactor = form_factor
+        return self.signedToMsg(msg)
+
     def unlockMsg(self):
         # unlocks the vehicle
         return self.rkeActionMsg(VCSEC_pb2.RKEAction_E.RKE_ACTION_UNLOCK)
@@ -488,8 +2943,21 @@ class TeslaMsgService:
         # closes the charge port
         return self.rkeActionMsg(VCSEC_pb2.RKEAction_E.RKE_ACTION_CLOSE_CHARGE_PORT)
 
+    def closureMoveMsg(self, moves):
+        # moves several closures in one message; moves maps ClosureMoveRequest
+        # field names to a ClosureMoveType_E
+        msg = VCSEC_pb2.UnsignedMessage()
+        request = msg.closureMoveRequest
+        for closure, move in moves.items():
+            setattr(request, closure, move)
+        return self.signedToMsg(msg)
+
     def rkeActionMsg(self, action):
         # executes the given RKE action
+        if action in self.__presign_actions:
+            frame = self.__takePresigned(action)
+            if frame is not None:
+                return frame
         msg = VCSEC_pb2.UnsignedMessage()
         msg.RKEAction = action
         return self.signedToMsg(msg)
@@ -509,11 +2977,43 @@ class TeslaMsgService:
     def vehicleStatusMsg(self):
         return self.informationRequestMsg(VCSEC_pb2.INFORMATION_REQUEST_TYPE_GET_STATUS)
 
-    def authenticationRequestMsg(self, level):
+    def capabilitiesMsg(self):
+        return self.informationRequestMsg(VCSEC_pb2.INFORMATION_REQUEST_TYPE_GET_CAPABILITIES)
+
+    def whitelistInfoMsg(self):
+        return self.informationRequestMsg(VCSEC_pb2.INFORMATION_REQUEST_TYPE_GET_WHITELIST_INFO)
+
+    def whitelistEntryInfoMsg(self, slot):
         msg = VCSEC_pb2.UnsignedMessage()
-        msg.authenticationResponse.authenticationLevel = level
+        info_request = msg.InformationRequest
+        info_request.informationRequestType = VCSEC_pb2.INFORMATION_REQUEST_TYPE_GET_WHITELIST_ENTRY_INFO
+        info_request.keyId.publicKeySHA1 = self.getKeyId()
+        info_request.slot = slot
         return self.signedToMsg(msg)
 
+    def authenticationRequestMsg(self, level, distance=None):
+        # the car keeps asking while the key is nearby, so the response for
+        # each level it asked for is pre-signed; a new distance replaces it
+        key = ("auth", level, distance)
+        with self.__presign_lock:
+            previous = self.__auth_levels.get(level)
+            if previous != key:
+                self.__auth_levels[level] = key
+                self.__presigned.pop(previous, None)
+        if previous != key:
+            self.__startPresigning()
+        frame = self.__takePresigned(key)
+        if frame is not None:
+            return frame
+        return self.signedToMsg(self.__authenticationResponse(level, distance))
+
+    def __authenticationResponse(self, level, distance):
+        msg = VCSEC_pb2.UnsignedMessage()
+        msg.authenticationResponse.authenticationLevel = level
+        if distance is not None:
+            msg.authenticationResponse.estimatedDistance = distance
+        return msg
+
     def vehiclePublicKeyMsg(self):
         # requests the public key of the vehicle
         msg = VCSEC_pb2.UnsignedMessage()
@@ -524,6 +3024,154 @@ class TeslaMsgService:
         return self.unsignedToMsg(msg)
 
 
+class ShortNonceAESGCM:
+    # AES-GCM as specified in NIST SP 800-38D, for the 4 byte nonces the car
+    # uses, which cryptography's AESGCM refuses. For nonces other than 96 bits
+    # the pre-counter block J0 is derived with GHASH.
+    #
+    # GHASH is not exposed by cryptography, so it is taken from the native
+    # AESGCM under a fixed 96-bit nonce: encrypting C xor that nonce's
+    # keystream yields ciphertext C, and a tag of E(J0') xor GHASH(A, C). The
+    # keystream and E(J0') are computed once per key with AES-ECB, which
+    # also encrypts this message's counter blocks. For a nonce of up to 16
+    # bytes J0 = N.H^2 xor len(N).H, which is one table lookup per nonce byte.
+    R = 0xE1 << 120
+    FIXED_NONCE = bytes(12)
+    # blocks -> (multiplier, addend) that turn a counter block into that many
+    STEPS = {}
+
+    def __init__(self, key):
+        self.__aead = AESGCM(key)
+        self.__ecb = Cipher(algorithms.AES(key), modes.ECB()).encryptor()
+        self.__ecb_lock = threading.Lock()
+        self.__h = int.from_bytes(self.__ecb.update(bytes(16)), "big")
+        # E(J0') and the keystream of the fixed nonce, which is all zeros
+        self.__mask = int.from_bytes(self.__ecb.update(bytes(15) + b"\x01"), "big")
+        # size -> the fixed nonce's keystream for that many bytes, as an int
+        self.__streams = {}
+        self.__h2 = self.__multiply(self.__h, self.__h)
+        # tables[i][b] is H^2 times byte value b at byte position i
+        self.__nonce_tables = []
+        self.__lengths = {}
+
+    def __multiply(self, x, y):
+        # x times y in GF(2^128), bit by bit; only used to build tables
+        z = 0
+        for i in range(127, -1, -1):
+            if x >> i & 1:
+                z ^= y
+            y = (y >> 1) ^ self.R if y & 1 else y >> 1
+        return z
+
+    def __nonceTables(self, size):
+        tables = self.__nonce_tables
+        if len(tables) >= size:
+            return tables
+        # powers[j] is H^2 times x^j, the block with only bit j set
+        powers = []
+        v = self.__h2
+        for _ in range(8 * size):
+            powers.append(v)
+            v = (v >> 1) ^ self.R if v & 1 else v >> 1
+        tables = list(tables)
+        for i in range(len(tables), size):
+            table = [0] * 256
+            for bit in range(8):
+                power = powers[8 * i + 7 - bit]
+                step = 1 << bit
+                for b in range(step, 2 * step):
+                    table[b] = table[b - step] ^ power
+            tables.append(table)
+        self.__nonce_tables = tables
+        return tables
+
+    def __fixedStream(self, size):
+        stream = self.__streams.get(size)
+        if stream is None:
+            # counter blocks of the fixed nonce start at inc32(J0') = 2
+            stream = int.from_bytes(self.__keystream(2, (size + 15) // 16)[:size], "big")
+            self.__streams[size] = stream
+        return stream
+
+    def __ghash(self, associated_data, ciphertext):
+        # GHASH(A, C) with the length block, through the native AESGCM
+        size = len(ciphertext)
+        plaintext = (int.from_bytes(ciphertext, "big") ^ self.__fixedStream(size)).to_bytes(size, "big")
+        tag = self.__aead.encrypt(self.FIXED_NONCE, plaintext, associated_data)[-16:]
+        return int.from_bytes(tag, "big") ^ self.__mask
+
+    def __j0(self, nonce):
+        if len(nonce) == 12:
+            return int.from_bytes(nonce + b"\x00\x00\x00\x01", "big")
+        # J0 is GHASH(pad(N) || [0]64 || [len(N)]64)
+        bits = len(nonce) * 8
+        if len(nonce) > 16:
+            # hashing N as associated data gives the same blocks, but with
+            # [len(N)]64 || [0]64 as the length block; swap it for the right one
+            return self.__ghash(nonce, b"") ^ self.__timesH(bits << 64 ^ bits)
+        j0 = self.__timesH(bits)
+        for table, byte in zip(self.__nonceTables(len(nonce)), nonce):
+            j0 ^= table[byte]
+        return j0
+
+    def __timesH(self, length_block):
+        # length blocks times H, cached since nonces have few lengths
+        value = self.__lengths.get(length_block)
+        if value is None:
+            value = self.__multiply(length_block, self.__h)
+            self.__lengths[length_block] = value
+        return value
+
+    def __keystream(self, icb, blocks):
+        # AES of the counter blocks from icb, of which GCM only increments
+        # the low 32 bits; without a wrap they are icb repeated plus 0, 1, ...
+        if (icb & 0xFFFFFFFF) + blocks <= 1 << 32:
+            steps = self.STEPS.get(blocks)
+            if steps is None:
+                steps = (sum(1 << 128 * i for i in range(blocks)),
+                         sum(blocks - 1 - i << 128 * i for i in range(blocks)))
+                self.STEPS[blocks] = steps
+            counters = (icb * steps[0] + steps[1]).to_bytes(16 * blocks, "big")
+        else:
+            prefix = icb >> 32 << 32
+            counters = b"".join(
+                (prefix | (icb + i) & 0xFFFFFFFF).to_bytes(16, "big") for i in range(blocks))
+        with self.__ecb_lock:
+            return self.__ecb.update(counters)
+
+    def __gctr(self, icb, data):
+        keystream = self.__keystream(icb, (len(data) + 15) // 16)
+        return (int.from_bytes(data, "big") ^ int.from_bytes(keystream[:len(data)], "big")).to_bytes(
+            len(data), "big")
+
+    def encrypt(self, nonce, data, associated_data):
+        size = len(data)
+        j0 = self.__j0(bytes(nonce))
+        # the first block is E(J0), which masks the tag; the rest encrypts
+        # the data starting from inc32(J0)
+        keystream = self.__keystream(j0, (size + 15) // 16 + 1)
+        ciphertext = int.from_bytes(data, "big") ^ int.from_bytes(keystream[16:16 + size], "big")
+        plaintext = (ciphertext ^ self.__fixedStream(size)).to_bytes(size, "big")
+        tag = self.__aead.encrypt(self.FIXED_NONCE, plaintext, associated_data or b"")[-16:]
+        tag = int.from_bytes(tag, "big") ^ self.__mask ^ int.from_bytes(keystream[:16], "big")
+        return ciphertext.to_bytes(size, "big") + tag.to_bytes(16, "big")
+
+
+# signed message faults caused by a counter the car has already seen
+COUNTER_FAULTS = (
+    VCSEC_pb2.SIGNEDMESSAGE_INFORMATION_FAULT_IV_SMALLER_THAN_EXPECTED,
+    VCSEC_pb2.SIGNEDMESSAGE_INFORMATION_FAULT_TOKEN_AND_COUNTER_INVALID,
+)
+
+
+class CommandError(Exception):
+    # raised through a command's Future when the car reports an error
+    def __init__(self, status):
+        Exception.__init__(self, "Vehicle rejected command: {}".format(
+            VCSEC_pb2.OperationStatus_E.Name(status.operationStatus)))
+        self.status = status
+
+
 class TeslaUUIDs:
     SERVICE_UUID = "00000211-b2d1-43f0-9b88-960cebf8b91e"       # Tesla Vehicle Service
     CHAR_WRITE_UUID = "00000212-b2d1-43f0-9b88-960cebf8b91e"    # To Vehicle
@@ -1,4 +1,5 @@
-from pyteslable.TeslaBLE import BLE, Vehicle, VehicleList
+from pyteslable.TeslaBLE import BLE, ScanRecord, PresenceEngine, Vehicle, VehicleList, VehicleState, CommandError, StatusHistory, StatusMonitor, WhitelistKey, Enrollment, WakeScheduler, SendQueue, TrafficShaper, RttEstimator, \
+    PRIORITY_INTERACTIVE, PRIORITY_AUTOMATION, PRIORITY_BACKGROUND
 from pyteslable import VCSEC_pb2
 """
 pyteslable
@@ -0,0 +1,125 @@
+import threading
+import time
+from concurrent.futures import wait
+
+import pytest
+
+from pyteslable import VCSEC_pb2
+from pyteslable.TeslaBLE import CommandError
+
+from conftest import notify
+
+
+def command_status(operation_status):
+    msg = VCSEC_pb2.FromVCSECMessage()
+    msg.commandStatus.operationStatus = operation_status
+    return msg
+
+
+def test_rke_commands_take_their_own_reply(make_vehicle):
+    vehicle, peripheral = make_vehicle()
+    unlocked = vehicle.unlock()
+    moved = vehicle.move_closures({"frontTrunk": "open"})
+    assert len(peripheral.writes) == 2
+    notify(vehicle, command_status(VCSEC_pb2.OPERATIONSTATUS_OK))
+    notify(vehicle, command_status(VCSEC_pb2.OPERATIONSTATUS_ERROR))
+    assert unlocked.result(0).operationStatus == VCSEC_pb2.OPERATIONSTATUS_OK
+    with pytest.raises(CommandError):
+        moved.result(0)
+
+
+@pytest.mark.parametrize("command", [
+    "unlock", "lock", "open_trunk", "open_frunk", "open_charge_port", "close_charge_port"])
+def test_rke_commands_resolve_on_command_status(make_vehicle, command):
+    vehicle, peripheral = make_vehicle()
+    future = getattr(vehicle, command)()
+    assert not future.done()
+    notify(vehicle, command_status(VCSEC_pb2.OPERATIONSTATUS_OK))
+    assert future.result(0).operationStatus == VCSEC_pb2.OPERATIONSTATUS_OK
+
+
+def test_unanswered_requests_time_out_without_traffic(make_vehicle):
+    vehicle, _ = make_vehicle()
+    backoffs = vehicle.rtt().backoffs
+    moved = vehicle.move_closures({"frontTrunk": "open"}, timeout=0.3)
+    info = vehicle.vehicle_info(timeout=0.3)
+    done, _ = wait([moved, info], timeout=2)
+    assert done == {moved, info}
+    assert isinstance(moved.exception(), TimeoutError)
+    assert isinstance(info.exception(), TimeoutError)
+    assert vehicle.rtt().backoffs == backoffs + 2
+    # a timed out information request is sent again rather than shared
+    assert vehicle.vehicle_info(timeout=0.3) is not info
+
+
+def test_invalid_batch_registers_nothing(make_vehicle):
+    vehicle, peripheral = make_vehicle()
+    with pytest.raises(ValueError):
+        vehicle.batch().unlock().move_closures({"bogus": "open"}).execute()
+    assert peripheral.writes == []
+    # nothing was left waiting to take the next command's reply
+    unlocked = vehicle.unlock()
+    notify(vehicle, command_status(VCSEC_pb2.OPERATIONSTATUS_OK))
+    assert unlocked.result(0).operationStatus == VCSEC_pb2.OPERATIONSTATUS_OK
+    assert len(vehicle._Vehicle__awaiting) == 0
+
+
+def test_batch_resolves_each_command(make_vehicle):
+    vehicle, peripheral = make_vehicle()
+
+    def answer():
+        # the car answers once both frames are on the wire
+        while len(peripheral.writes) < 2:
+            time.sleep(0.001)
+        notify(vehicle, command_status(VCSEC_pb2.OPERATIONSTATUS_OK))
+        notify(vehicle, command_status(VCSEC_pb2.OPERATIONSTATUS_ERROR))
+
+    car = threading.Thread(target=answer)
+    car.start()
+    results = vehicle.batch().unlock().open_charge_port().execute(timeout=2)
+    car.join()
+    assert len(peripheral.writes) == 2
+    assert results[0].operationStatus == VCSEC_pb2.OPERATIONSTATUS_OK
+    assert isinstance(results[1], CommandError)
+
+
+def counter_fault(counter=0):
+    msg = command_status(VCSEC_pb2.OPERATIONSTATUS_ERROR)
+    msg.commandStatus.signedMessageStatus.counter = counter
+    msg.commandStatus.signedMessageStatus.signedMessageInformation = \
+        VCSEC_pb2.SIGNEDMESSAGE_INFORMATION_FAULT_IV_SMALLER_THAN_EXPECTED
+    return msg
+
+
+def test_unknown_counter_fault_retries_oldest_command(make_vehicle):
+    vehicle, peripheral = make_vehicle()
+    unlocked = vehicle.unlock()
+    notify(vehicle, counter_fault())
+    # only the unlock was in flight, so it was signed again
+    assert len(peripheral.writes) == 2
+    notify(vehicle, command_status(VCSEC_pb2.OPERATIONSTATUS_OK))
+    assert unlocked.result(0).operationStatus == VCSEC_pb2.OPERATIONSTATUS_OK
+
+
+def test_unknown_counter_fault_with_untracked_frame_in_flight(make_vehicle):
+    vehicle, peripheral = make_vehicle()
+    opened = vehicle.open_trunk()
+    vehicle.vehicle_status()
+    notify(vehicle, counter_fault())
+    # the fault may be the status poll's, so the trunk command is kept
+    assert len(peripheral.writes) == 2
+    assert not opened.done()
+    notify(vehicle, command_status(VCSEC_pb2.OPERATIONSTATUS_OK))
+    assert opened.result(0).operationStatus == VCSEC_pb2.OPERATIONSTATUS_OK
+
+
+def test_submit_returns_before_the_replies(make_vehicle):
+    vehicle, peripheral = make_vehicle()
+    started = time.perf_counter()
+    futures = vehicle.batch().unlock().lock().submit(timeout=2)
+    assert time.perf_counter() - started < 1
+    assert len(peripheral.writes) == 2
+    assert not any(future.done() for future in futures)
+    notify(vehicle, command_status(VCSEC_pb2.OPERATIONSTATUS_OK))
+    notify(vehicle, command_status(VCSEC_pb2.OPERATIONSTATUS_OK))
+    assert all(future.result(0).operationStatus == VCSEC_pb2.OPERATIONSTATUS_OK for future in futures)
@@ -0,0 +1,129 @@
+import threading
+import time
+
+from pyteslable import VCSEC_pb2
+from pyteslable.TeslaBLE import _frameCounter
+
+from conftest import notify
+
+THREADS = 8
+MESSAGES = 200
+
+
+def status_message(lock_state):
+    msg = VCSEC_pb2.FromVCSECMessage()
+    msg.vehicleStatus.vehicleLockState = lock_state
+    return msg
+
+
+def run_threads(target, count):
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def auth_request(level):
+    msg = VCSEC_pb2.FromVCSECMessage()
+    msg.authenticationRequest.requestedLevel = level
+    return msg
+
+
+def test_signed_counters_unique_across_threads(make_vehicle):
+    vehicle, peripheral = make_vehicle()
+    vehicle.authInterval(0)
+    done = threading.Event()
+
+    def notifier():
+        # the car asks for authentication while commands are being signed,
+        # so the responder signs concurrently with the senders
+        i = 0
+        while not done.is_set():
+            notify(vehicle, status_message(i % 2 + 1))
+            notify(vehicle, auth_request(VCSEC_pb2.AUTHENTICATION_LEVEL_UNLOCK + i % 2))
+            i += 1
+
+    def signer(index):
+        for _ in range(MESSAGES):
+            vehicle.lock()
+
+    notify_thread = threading.Thread(target=notifier)
+    notify_thread.start()
+    try:
+        run_threads(signer, THREADS)
+    finally:
+        done.set()
+        notify_thread.join()
+    # let the responder answer the last requests
+    time.sleep(0.1)
+
+    assert vehicle.metrics()["auth_responses"] > 0
+    # every lock and every authentication response, each with its own counter
+    wire = [_frameCounter(data) for data in list(peripheral.writes)]
+    assert len(wire) > THREADS * MESSAGES
+    assert all(a < b for a, b in zip(wire, wire[1:]))
+
+
+def test_wire_counters_increase(make_vehicle):
+    vehicle, peripheral = make_vehicle()
+
+    def sender(index):
+        for _ in range(MESSAGES // 4):
+            vehicle.lock()
+
+    run_threads(sender, THREADS)
+
+    wire = [_frameCounter(data) for data in peripheral.writes]
+    assert len(wire) == THREADS * MESSAGES // 4
+    assert all(a < b for a, b in zip(wire, wire[1:]))
+
+
+def test_counter_persisted_past_last_sent(make_vehicle):
+    vehicle, peripheral = make_vehicle()
+    for _ in range(10):
+        vehicle.lock()
+    last = _frameCounter(peripheral.writes[-1])
+    with open(vehicle.file_name) as f:
+        assert int(f.read().split()[1]) > last
+
+
+def test_counters_increase_across_processes_sharing_a_key(make_vehicle):
+    # two vehicles on one file stand in for two processes sharing a key
+    first, first_peripheral = make_vehicle()
+    second, second_peripheral = make_vehicle()
+    wire = []
+    for _ in range(5):
+        for vehicle, peripheral in ((first, first_peripheral), (second, second_peripheral)):
+            vehicle.lock()
+            wire.append(_frameCounter(peripheral.writes[-1]))
+    assert all(a < b for a, b in zip(wire, wire[1:]))
+
+
+def answered(vehicle, peripheral, count):
+    # asks for unlock authentication and waits for the response to be written
+    notify(vehicle, auth_request(VCSEC_pb2.AUTHENTICATION_LEVEL_UNLOCK))
+    deadline = time.time() + 2
+    while len(peripheral.writes) < count and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(peripheral.writes) == count
+    # give the background signer time to prepare the next response
+    time.sleep(0.1)
+
+
+def test_authentication_responses_are_presigned(make_vehicle):
+    vehicle, peripheral = make_vehicle()
+    vehicle.authInterval(0)
+    answered(vehicle, peripheral, 1)
+    answered(vehicle, peripheral, 2)
+    answered(vehicle, peripheral, 3)
+    assert vehicle.metrics()["presign_hits"] == 2
+    # a new distance estimate makes the prepared response stale
+    peripheral.rssi = lambda: -75
+    answered(vehicle, peripheral, 4)
+    answered(vehicle, peripheral, 5)
+    metrics = vehicle.metrics()
+    assert metrics["presign_hits"] == 3
+    assert metrics["presign_misses"] == 2
+    wire = [_frameCounter(data) for data in peripheral.writes]
+    assert all(a < b for a, b in zip(wire, wire[1:]))
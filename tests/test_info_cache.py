@@ -0,0 +1,47 @@
+from pyteslable import VCSEC_pb2
+
+from conftest import FakePeripheral
+
+VIN = "5YJ3E1EA7KF000001"
+
+
+class VersionedPeripheral(FakePeripheral):
+    # serves version from the version characteristic; None fails the read
+    def __init__(self, version):
+        FakePeripheral.__init__(self)
+        self.version = version
+
+    def read(self, service, characteristic):
+        if self.version is None:
+            raise RuntimeError("read failed")
+        return self.version
+
+
+def connect_with(make_vehicle, version):
+    vehicle, _ = make_vehicle(VersionedPeripheral(version))
+    return vehicle
+
+
+def test_cache_served_when_version_matches(make_vehicle):
+    vehicle = connect_with(make_vehicle, b"\x01\x02")
+    vehicle.setVehicleInfo(VCSEC_pb2.VehicleInfo(VIN=VIN))
+    assert connect_with(make_vehicle, b"\x01\x02").vin() == VIN
+
+
+def test_cache_dropped_when_version_changes(make_vehicle):
+    vehicle = connect_with(make_vehicle, b"\x01\x02")
+    vehicle.setVehicleInfo(VCSEC_pb2.VehicleInfo(VIN=VIN))
+    assert connect_with(make_vehicle, b"\x01\x03").vin() is None
+    assert connect_with(make_vehicle, b"\x01\x02").vin() is None
+
+
+def test_cache_not_trusted_without_version(make_vehicle):
+    vehicle = connect_with(make_vehicle, b"\x01\x02")
+    vehicle.setVehicleInfo(VCSEC_pb2.VehicleInfo(VIN=VIN))
+    unverified = connect_with(make_vehicle, None)
+    assert unverified.vin() is None
+    assert unverified.version() is None
+    assert unverified.whitelistKeys() is None
+    # what is fetched meanwhile is not saved under the old version
+    unverified.setVehicleInfo(VCSEC_pb2.VehicleInfo(VIN="5YJ3E1EA7KF000002"))
+    assert connect_with(make_vehicle, b"\x01\x02").vin() == VIN
@@ -0,0 +1,91 @@
+import threading
+import time
+from concurrent.futures import wait
+
+from pyteslable import VCSEC_pb2
+from pyteslable.TeslaBLE import CommandError
+
+from conftest import frame
+
+
+def status_message(lock_state):
+    msg = VCSEC_pb2.FromVCSECMessage()
+    msg.vehicleStatus.vehicleLockState = lock_state
+    return msg
+
+
+def command_status(operation_status):
+    msg = VCSEC_pb2.FromVCSECMessage()
+    msg.commandStatus.operationStatus = operation_status
+    return msg
+
+
+def test_full_queue_sheds_status_but_never_replies(make_vehicle):
+    vehicle, peripheral = make_vehicle()
+    vehicle.notificationQueue(2)
+    gate = threading.Event()
+    busy = threading.Event()
+    states = []
+
+    def slow_listener(vehicle, state, changed):
+        states.append(state.get("vehicleLockState"))
+        busy.set()
+        gate.wait(5)
+
+    vehicle.onStateChange(slow_listener)
+    futures = [vehicle.unlock(timeout=5) for _ in range(3)]
+    # the worker is stuck in the listener while everything else arrives
+    peripheral.notify(frame(status_message(1)))
+    assert busy.wait(2)
+    ok = VCSEC_pb2.OPERATIONSTATUS_OK
+    for msg in (status_message(2), command_status(ok), status_message(1), status_message(2),
+                command_status(ok), status_message(1), command_status(VCSEC_pb2.OPERATIONSTATUS_ERROR)):
+        peripheral.notify(frame(msg))
+    gate.set()
+
+    done, _ = wait(futures, timeout=2)
+    assert len(done) == 3
+    assert futures[0].result().operationStatus == ok
+    assert futures[1].result().operationStatus == ok
+    assert isinstance(futures[2].exception(), CommandError)
+    metrics = vehicle.metrics()
+    assert metrics["notify_dropped_status"] == 2
+    assert metrics["notify_dropped"] == 2
+    # the newest status was kept
+    assert states[-1] == 1
+
+
+def test_retry_from_timeout_callback_keeps_worker_running(make_vehicle):
+    vehicle, peripheral = make_vehicle()
+    retried = []
+    retry_sent = threading.Event()
+
+    def retry(future):
+        retried.append(vehicle.vehicle_status(timeout=5))
+        retry_sent.set()
+
+    vehicle.vehicle_status(timeout=0.1).add_done_callback(retry)
+    assert retry_sent.wait(2)
+    # the worker must still be processing notifications
+    peripheral.notify(frame(status_message(1)))
+    assert retried[0].result(2).get("vehicleLockState") == 1
+
+
+def test_status_request_racing_a_status_update_is_answered(make_vehicle):
+    vehicle, peripheral = make_vehicle()
+    earlier = vehicle.vehicle_status(timeout=2)
+    futures = []
+    # hold the next request just before it registers, while the status
+    # answering the earlier one arrives
+    lock = vehicle._Vehicle__inflight_lock
+    lock.acquire()
+    requester = threading.Thread(target=lambda: futures.append(vehicle.vehicle_status(timeout=2)))
+    requester.start()
+    time.sleep(0.1)
+    peripheral.notify(frame(status_message(1)))
+    time.sleep(0.1)
+    lock.release()
+    requester.join()
+    peripheral.notify(frame(status_message(2)))
+    assert earlier.result(1).get("vehicleLockState") == 1
+    assert futures[0].result(1).get("vehicleLockState") in (1, 2)
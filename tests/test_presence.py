@@ -0,0 +1,35 @@
+from pyteslable.TeslaBLE import PresenceEngine
+
+from conftest import AdvertisingPeripheral, tesla_beacon
+
+# an iBeacon with another UUID, as an iPhone or AirPods might send
+APPLE_BEACON = bytes([0x02, 0x15]) + bytes(16) + bytes([0, 1, 0, 2, 0xC5])
+
+
+def advertise(engine, peripheral):
+    engine._PresenceEngine__onAdvertisement(peripheral)
+
+
+def test_only_tesla_beacons_are_tracked():
+    engine = PresenceEngine()
+    events = []
+    engine.onEvent(lambda event, address, rssi: events.append((event, address)))
+    tesla = AdvertisingPeripheral("AA:00:00:00:00:01", tesla_beacon())
+    phone = AdvertisingPeripheral("AA:00:00:00:00:02", APPLE_BEACON)
+    headphones = AdvertisingPeripheral("AA:00:00:00:00:03", b"\x07\x19\x01")
+    for peripheral in (tesla, phone, headphones):
+        advertise(engine, peripheral)
+    assert engine.present() == [tesla.address()]
+    assert events == [("enter", tesla.address()), ("near", tesla.address())]
+
+
+def test_verdict_is_cached_per_address():
+    engine = PresenceEngine()
+    phone = AdvertisingPeripheral("AA:00:00:00:00:02", APPLE_BEACON)
+    tesla = AdvertisingPeripheral("AA:00:00:00:00:01", tesla_beacon())
+    for _ in range(5):
+        advertise(engine, phone)
+        advertise(engine, tesla)
+    assert phone.reads == 1
+    assert tesla.reads == 1
+    assert engine.isNear(tesla.address())
@@ -0,0 +1,51 @@
+import time
+from concurrent.futures import wait
+
+from conftest import FakePeripheral
+
+
+class FlakyPeripheral(FakePeripheral):
+    # refuses to connect while refuse is set
+    def __init__(self):
+        FakePeripheral.__init__(self)
+        self.refuse = False
+
+    def connect(self):
+        if self.refuse:
+            raise RuntimeError("connection refused")
+        FakePeripheral.connect(self)
+
+
+def drop_link(make_vehicle):
+    vehicle, peripheral = make_vehicle(FlakyPeripheral())
+    vehicle.autoReconnect(base_delay=0.02, max_delay=0.05)
+    peripheral.refuse = True
+    peripheral.connected = False
+    return vehicle, peripheral
+
+
+def reconnect(vehicle, peripheral):
+    peripheral.refuse = False
+    deadline = time.time() + 2
+    while (vehicle.isReconnecting() or not peripheral.connected) and time.time() < deadline:
+        time.sleep(0.01)
+    # let the replay finish
+    time.sleep(0.05)
+
+
+def test_queued_command_replayed_after_reconnect(make_vehicle):
+    vehicle, peripheral = drop_link(make_vehicle)
+    unlocked = vehicle.unlock(timeout=5)
+    assert peripheral.writes == []
+    reconnect(vehicle, peripheral)
+    assert len(peripheral.writes) == 1
+    assert not unlocked.done()
+
+
+def test_timed_out_command_not_replayed(make_vehicle):
+    vehicle, peripheral = drop_link(make_vehicle)
+    unlocked = vehicle.unlock(timeout=0.1)
+    wait([unlocked], timeout=2)
+    assert isinstance(unlocked.exception(), TimeoutError)
+    reconnect(vehicle, peripheral)
+    assert peripheral.writes == []
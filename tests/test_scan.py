@@ -0,0 +1,65 @@
+import simplepyble
+
+from pyteslable.TeslaBLE import BLE, parseAdvertisement
+
+from conftest import AdvertisingPeripheral, per_call, tesla_beacon
+
+APPLE_BEACON = bytes([0x02, 0x15]) + bytes(16) + bytes([0, 1, 0, 2, 0xC5])
+
+
+class FakeAdapter:
+    def __init__(self, address, peripherals):
+        self._address = address
+        self.peripherals = peripherals
+
+    def identifier(self):
+        return "hci-" + self._address
+
+    def address(self):
+        return self._address
+
+    def scan_for(self, time):
+        pass
+
+    def scan_get_results(self):
+        return self.peripherals
+
+    def get_connected_peripherals(self):
+        return []
+
+
+def scanning(monkeypatch, *adapters):
+    monkeypatch.setattr(simplepyble.Adapter, "get_adapters", lambda: list(adapters))
+    return BLE()
+
+
+def test_discover_skips_other_apple_devices(monkeypatch):
+    tesla = AdvertisingPeripheral("AA:00:00:00:00:01", tesla_beacon(major=7))
+    phone = AdvertisingPeripheral("AA:00:00:00:00:02", APPLE_BEACON)
+    headphones = AdvertisingPeripheral("AA:00:00:00:00:03", b"\x07\x19\x01")
+    silent = AdvertisingPeripheral("AA:00:00:00:00:04", None)
+    ble = scanning(monkeypatch, FakeAdapter("00:00:00:00:00:01", [tesla, phone, headphones, silent]))
+    records = ble.discover()
+    assert [record.address for record in records] == [tesla.address()]
+    assert records[0].isTesla()
+    assert records[0].advertisement.major == 7
+    assert [vehicle.address() for vehicle in ble.scan()] == [tesla.address()]
+
+
+def test_advertisement_cache_is_bounded(monkeypatch):
+    peripherals = [AdvertisingPeripheral("AA:00:00:00:{:02X}:{:02X}".format(i >> 8, i & 0xFF),
+                                         APPLE_BEACON) for i in range(BLE.ADVERTISEMENT_CACHE + 50)]
+    tesla = AdvertisingPeripheral("AA:FF:00:00:00:01", tesla_beacon())
+    ble = scanning(monkeypatch, FakeAdapter("00:00:00:00:00:01", [tesla] + peripherals))
+    ble.discover()
+    assert len(ble._BLE__advertisements) == BLE.ADVERTISEMENT_CACHE
+    # the oldest addresses were evicted, the most recent are still cached
+    assert ble.advertisement(tesla.address()) is None
+    assert ble.advertisement(peripherals[-1].address()) is not None
+
+
+def test_parse_advertisement_benchmark():
+    data = tesla_beacon()
+    cost = per_call(lambda: parseAdvertisement(data))
+    print("parseAdvertisement: {:.2f} us".format(cost * 1e6))
+    assert cost < 50e-6
@@ -0,0 +1,158 @@
+import random
+
+from google.protobuf.internal import api_implementation
+from google.protobuf.message import DecodeError
+
+from pyteslable import VCSEC_pb2
+from pyteslable.TeslaBLE import VehicleState, decodeVehicleStatus
+
+from conftest import per_call
+
+SEED = 0x7E51A
+CASES = 3000
+
+
+def random_status(rng):
+    msg = VCSEC_pb2.FromVCSECMessage()
+    status = msg.vehicleStatus
+    status.SetInParent()
+    for name in VehicleState.CLOSURES:
+        if rng.random() < 0.8:
+            setattr(status.closureStatuses, name, rng.randrange(4))
+    if rng.random() < 0.8:
+        status.vehicleLockState = rng.randrange(4)
+    if rng.random() < 0.8:
+        status.vehicleSleepStatus = rng.randrange(3)
+    return msg
+
+
+def varint(value, padding=0):
+    # padding adds redundant continuation bytes, which parsers must accept
+    out = bytearray()
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    if padding:
+        out[-1] |= 0x80
+        out += b"\x80" * (padding - 1) + b"\x00"
+    return bytes(out)
+
+
+def raw_status(rng):
+    # legal encodings the generated serializer never produces: fields out of
+    # order or repeated, padded varints, unknown fields, values out of range
+    def value():
+        return rng.randrange(8) if rng.random() < 0.1 else rng.randrange(4)
+
+    def padding():
+        return rng.randrange(3) if rng.random() < 0.2 else 0
+
+    fields = []
+    for _ in range(rng.randrange(5)):
+        closures = b"".join(
+            varint(rng.randrange(1, 8) << 3) + varint(value(), padding())
+            for _ in range(rng.randrange(8)))
+        fields.append(b"\x0a" + varint(len(closures)) + closures)
+    for _ in range(rng.randrange(4)):
+        fields.append(rng.choice((b"\x10", b"\x18")) + varint(value(), padding()))
+    if rng.random() < 0.1:
+        fields.append(varint(rng.randrange(4, 16) << 3) + varint(rng.randrange(300)))
+    rng.shuffle(fields)
+    body = b"".join(fields)
+    return b"\x0a" + varint(len(body), padding()) + body
+
+
+def mutate(rng, data):
+    data = bytearray(data)
+    choice = rng.randrange(4)
+    if choice == 0 and data:
+        data[rng.randrange(len(data))] ^= 1 << rng.randrange(8)
+    elif choice == 1 and data:
+        del data[rng.randrange(len(data)):]
+    elif choice == 2:
+        position = rng.randrange(len(data) + 1)
+        data[position:position] = bytes(rng.randrange(256) for _ in range(rng.randrange(1, 4)))
+    elif data:
+        data[rng.randrange(len(data))] = rng.randrange(256)
+    return bytes(data)
+
+
+def protobuf_bits(data):
+    # what the generated parser makes of data, or None if it would not take
+    # the vehicleStatus path
+    msg = VCSEC_pb2.FromVCSECMessage()
+    try:
+        msg.ParseFromString(data)
+    except DecodeError:
+        return None
+    if not msg.HasField("vehicleStatus"):
+        return None
+    return int(VehicleState.fromStatus(msg.vehicleStatus))
+
+
+def check(data):
+    bits = decodeVehicleStatus(data)
+    if bits is not None:
+        assert bits == protobuf_bits(data), data.hex()
+
+
+def test_valid_statuses_decode_like_protobuf():
+    rng = random.Random(SEED)
+    for _ in range(CASES):
+        data = random_status(rng).SerializeToString()
+        bits = decodeVehicleStatus(data)
+        assert bits is not None, data.hex()
+        assert bits == protobuf_bits(data), data.hex()
+
+
+def test_fuzzed_input_never_disagrees_with_protobuf():
+    # the fast path may give up on anything, but whatever it does decode
+    # must match the generated parser
+    rng = random.Random(SEED + 1)
+    for _ in range(CASES):
+        data = random_status(rng).SerializeToString()
+        for _ in range(rng.randrange(1, 4)):
+            data = mutate(rng, data)
+        check(data)
+    for _ in range(CASES):
+        check(bytes(rng.randrange(256) for _ in range(rng.randrange(24))))
+
+
+def test_unusual_encodings_decode_like_protobuf():
+    rng = random.Random(SEED + 2)
+    decoded = 0
+    for _ in range(CASES):
+        data = raw_status(rng)
+        check(data)
+        decoded += decodeVehicleStatus(data) is not None
+    # most of these must take the fast path, or the test proves little
+    assert decoded > CASES // 2
+
+
+def test_other_messages_fall_back():
+    msg = VCSEC_pb2.FromVCSECMessage()
+    msg.commandStatus.operationStatus = 1
+    assert decodeVehicleStatus(msg.SerializeToString()) is None
+    msg = VCSEC_pb2.FromVCSECMessage()
+    msg.sessionInfo.counter = 5
+    assert decodeVehicleStatus(msg.SerializeToString()) is None
+
+
+def test_decode_benchmark():
+    data = random_status(random.Random(SEED)).SerializeToString()
+
+    def parse():
+        msg = VCSEC_pb2.FromVCSECMessage()
+        msg.ParseFromString(data)
+        return VehicleState.fromStatus(msg.vehicleStatus)
+
+    cost = per_call(lambda: decodeVehicleStatus(data))
+    protobuf_cost = per_call(parse)
+    print("decodeVehicleStatus: {:.2f} us ({:.0f}/s), protobuf ({}): {:.2f} us".format(
+        cost * 1e6, 1 / cost, api_implementation.Type(), protobuf_cost * 1e6))
+    # the fast path only has to beat the pure Python parser; the upb and C++
+    # backends parse in native code
+    assert cost < 50e-6
+    if api_implementation.Type() == "python":
+        assert cost < protobuf_cost